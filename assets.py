@@ -0,0 +1,208 @@
+# assets.py
+"""In-memory static assets: the front page and everything under static/.
+
+Files are read once into an asset table with a content hash and precompressed
+gzip (and brotli, when the brotli package is installed) variants, and served from
+memory with ETags. Every file is also reachable under a fingerprinted name,
+/static/app.<hash>.js for static/app.js, which is served with a one-year
+immutable Cache-Control; asset_url() gives that name. Plain names revalidate.
+With STATIC_WATCH=1 (serve.py --reload) the table is reloaded when files change.
+"""
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+from dataclasses import dataclass, field
+from typing import Dict
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+STATIC_WATCH = os.getenv("STATIC_WATCH", "0") == "1"
+STATIC_WATCH_INTERVAL = float(os.getenv("STATIC_WATCH_INTERVAL", "1"))
+# Only text-like files this big are worth precompressing
+STATIC_COMPRESS_MIN_SIZE = int(os.getenv("STATIC_COMPRESS_MIN_SIZE", "256"))
+# API responses: gzip whole (non-streamed) bodies of at least this many bytes
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))  # per-request cost; static assets use 9
+GZIP_EXCLUDED_PATHS = ("/todos/stream",)
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Asset:
+    path: str  # relative to the static directory, with forward slashes
+    body: bytes
+    content_type: str
+    digest: str
+    mtime: float
+    encodings: Dict[str, bytes] = field(default_factory=dict)  # "br"/"gzip" -> compressed body
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest}"'
+
+    @property
+    def fingerprinted_path(self) -> str:
+        stem, ext = posixpath.splitext(self.path)
+        return f"{stem}.{self.digest[:12]}{ext}"
+
+
+def load_asset(directory: str, path: str) -> Asset:
+    full_path = os.path.join(directory, path)
+    with open(full_path, "rb") as f:
+        body = f.read()
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type == "application/javascript":
+        content_type += "; charset=utf-8"
+    asset = Asset(path, body, content_type, hashlib.sha256(body).hexdigest()[:32], os.path.getmtime(full_path))
+    if len(body) >= STATIC_COMPRESS_MIN_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+        candidates = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            candidates["br"] = brotli.compress(body)
+        # Keep only variants that actually save bytes
+        asset.encodings = {name: data for name, data in candidates.items() if len(data) < len(body)}
+    return asset
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    return any(candidate.strip().removeprefix("W/") in (etag, "*") for candidate in if_none_match.split(","))
+
+
+class AssetTable:
+    def __init__(self, directory: str = STATIC_DIR):
+        self.directory = directory
+        self.assets: Dict[str, Asset] = {}
+        self._by_fingerprint: Dict[str, Asset] = {}
+        self._loaded = False
+
+    def _scan(self) -> Dict[str, float]:
+        found = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                found[os.path.relpath(full_path, self.directory).replace(os.sep, "/")] = os.path.getmtime(full_path)
+        return found
+
+    def load(self):
+        """(Re)build the table, reusing assets whose files haven't changed."""
+        assets = {}
+        for path, mtime in self._scan().items():
+            current = self.assets.get(path)
+            assets[path] = current if current is not None and current.mtime == mtime else load_asset(self.directory, path)
+        self.assets = assets
+        self._by_fingerprint = {asset.fingerprinted_path: asset for asset in assets.values()}
+        self._loaded = True
+        logger.debug("Loaded %d static assets from %s", len(assets), self.directory)
+
+    def changed(self) -> bool:
+        return {path: asset.mtime for path, asset in self.assets.items()} != self._scan()
+
+    def lookup(self, path: str):
+        """(asset, fingerprinted) for a request path relative to the static directory."""
+        if not self._loaded:
+            self.load()
+        path = path.lstrip("/")
+        asset = self.assets.get(path)
+        if asset is not None:
+            return asset, False
+        asset = self._by_fingerprint.get(path)
+        return asset, asset is not None
+
+    def url(self, path: str, prefix: str = "/static") -> str:
+        asset, _ = self.lookup(path)
+        return f"{prefix}/{asset.fingerprinted_path}" if asset else f"{prefix}/{path.lstrip('/')}"
+
+    def response(self, asset: Asset, headers: Headers, fingerprinted: bool = False, method: str = "GET") -> Response:
+        response_headers = {
+            "ETag": asset.etag,
+            "Cache-Control": IMMUTABLE if fingerprinted else REVALIDATE,
+        }
+        if asset.encodings:
+            response_headers["Vary"] = "Accept-Encoding"
+        if_none_match = headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, asset.etag):
+            return Response(status_code=304, headers=response_headers)
+
+        body = asset.body
+        accepted = accepted_encodings(headers.get("accept-encoding", ""))
+        for encoding in ("br", "gzip"):
+            if encoding in asset.encodings and encoding in accepted:
+                body = asset.encodings[encoding]
+                response_headers["Content-Encoding"] = encoding
+                break
+        response = Response(body, media_type=asset.content_type, headers=response_headers)
+        if method == "HEAD":
+            response.body = b""
+        return response
+
+    async def watch(self, interval: float = STATIC_WATCH_INTERVAL):
+        """Development: reload the table whenever files under the directory change."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await asyncio.to_thread(self.changed):
+                    await asyncio.to_thread(self.load)
+                    logger.info("Static assets reloaded")
+            except OSError:
+                logger.exception("Static asset reload failed")
+
+
+assets = AssetTable()
+
+def asset_url(path: str) -> str:
+    """Cache-busting URL of a static file, e.g. for templates."""
+    return assets.url(path)
+
+
+class StaticAssets:
+    """ASGI app for the /static mount, serving from the asset table."""
+
+    def __init__(self, table: AssetTable = assets):
+        self.table = table
+
+    async def __call__(self, scope, receive, send):
+        method = scope["method"]
+        asset, fingerprinted = self.table.lookup(scope["path"][len(scope.get("root_path", "")):])
+        if method not in ("GET", "HEAD"):
+            response = Response(status_code=405, headers={"Allow": "GET, HEAD"})
+        elif asset is None:
+            response = Response("Not Found", status_code=404, media_type="text/plain")
+        else:
+            response = self.table.response(asset, Headers(scope=scope), fingerprinted, method)
+        await response(scope, receive, send)
+
+
+class ApiGZipMiddleware(GZipMiddleware):
+    """Starlette's gzip, minus live streams (gzip would hold events back in its buffer).
+    Responses that already carry a Content-Encoding, like static assets, pass through."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(GZIP_EXCLUDED_PATHS):
+            return await self.app(scope, receive, send)
+        await super().__call__(scope, receive, send)
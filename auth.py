@@ -1,31 +1,42 @@
 # auth.py
 import logging
+import os
+import time
 
-from fastapi import Depends, HTTPException, status
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException, Query, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from database import SessionLocal, User
-from datetime import datetime, timedelta
-from jose import JWTError, jwt
+from database import AsyncSessionLocal, User, UserDirectory, placement_shard, shard_session
+from shards import lookup_user
+from datetime import timedelta
+from jose import JWTError
+from cache import TTLCache
+from idempotency import fingerprint, idempotency_store
+from metrics import observe_bcrypt
+from ratelimit import limit_login_by_ip, rate_limiter
+from passwords import hash_password_async, verify_and_update_password
+from tokens import ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, create_token, decode_token, revocations
+
+# Signing keys, algorithm and token lifetimes are configured in tokens.py
 
-# Secret and algorithm configuration
-SECRET_KEY = "your_secret_key"  # Change this to a strong secret key
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Verified identities cached per bearer token so authenticated requests skip the users lookup
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Passwords are hashed and verified off the event loop by passwords.py (cost: BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 # Dependency to get the DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 class UserCreate(BaseModel):
     username: str
@@ -37,89 +48,211 @@ class UserInDB(UserCreate):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
 
 class TokenData(BaseModel):
     username: str
 
-# Hashing and verification functions
-def hash_password(password: str):
-    return pwd_context.hash(password)
+class UserResponse(BaseModel):
+    id: int
+    username: str
+
+    class Config:
+        from_attributes = True  # Replacing orm_mode
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+class CurrentUser(UserResponse):
+    shard: int = 0  # database shard holding the user's todos
 
 # JWT utility functions
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire, "sub": data.get("sub")})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
-
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+    sub = to_encode.pop("sub")
+    expires_in = expires_delta.total_seconds() if expires_delta else ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    return create_token(sub, "access", expires_in, **to_encode)
+
+def create_refresh_token(username: str):
+    return create_token(username, "refresh", REFRESH_TOKEN_EXPIRE_DAYS * 86400)
+
+def issue_tokens(username: str) -> Token:
+    return Token(
+        access_token=create_access_token({"sub": username}),
+        refresh_token=create_refresh_token(username),
+        token_type="bearer",
+        expires_in=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    )
+
+def credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def verify_token(token: str, token_type: str = "access") -> dict:
+    # Signature checks are cached per token (tokens.decode_token); revocation is a set lookup
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
+        claims = decode_token(token, token_type)
     except JWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.username == token_data.username).first()
-    if user is None:
-        raise credentials_exception
-    return user
+        raise credentials_exception()
+    if claims.get("sub") is None or revocations.is_revoked(claims):
+        raise credentials_exception()
+    return claims
 
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    claims = verify_token(token)
+    cached = user_cache.get(token)
+    if cached is not None:
+        return cached
 
+    # The directory (shard 0) knows the user's id and shard; no need to read the users row
+    token_data = TokenData(username=claims["sub"])
+    entry = await lookup_user(db, token_data.username)
+    if entry is None:
+        raise credentials_exception()
+    current_user = CurrentUser(id=entry.id, username=entry.username, shard=entry.shard)
+    # Never cache past the token's own expiry
+    user_cache.set(token, current_user, ttl=claims["exp"] - time.time(), tag=current_user.username)
+    return current_user
 
-class UserResponse(BaseModel):
-    id: int
-    username: str
 
-    class Config:
-        from_attributes = True  # Replacing orm_mode
+async def get_user_db(user: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Session on the shard that holds the current user's todos."""
+    async with shard_session(db, user.shard) as shard_db:
+        yield shard_db
+
+
+def revoke_token(token: str, token_type: str = "access"):
+    try:
+        claims = decode_token(token, token_type)
+    except JWTError:
+        return  # already unusable
+    revocations.revoke(claims["jti"], claims["exp"])
+    user_cache.delete(token)
+
+def revoke_user_tokens(username: str):
+    """Forced logout: every token issued to the user so far stops working."""
+    revocations.revoke_subject(username)
+    invalidate_user(username)
+
+
+async def get_current_user_from_header_or_query(
+    token: Optional[str] = Depends(optional_oauth2_scheme),
+    access_token: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_db),
+):
+    # Browsers' EventSource can't send an Authorization header, so also accept ?access_token=
+    token = token or access_token
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await get_current_user(token, db)
+
+
+# Cache invalidation hooks: drop every cached token of a user that is deleted or changes password
+def invalidate_user(username: str):
+    user_cache.invalidate_tag(username)
+
+@event.listens_for(User, "after_delete")
+def _invalidate_deleted_user(mapper, connection, target):
+    invalidate_user(target.username)
+
+@event.listens_for(User, "after_update")
+def _invalidate_updated_user(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.password_hash.history.has_changes() or state.attrs.username.history.has_changes():
+        invalidate_user(target.username)
+        for old_username in state.attrs.username.history.deleted:
+            invalidate_user(old_username)
 
 
 # Define routes directly
 def add_auth_routes(app):
-    @app.post("/register", response_model=UserResponse)
-    def register(user: UserCreate, db: Session = Depends(get_db)):
-        print(f"Received registration data: {user}")
+    # Login-type routes share a per-IP budget; /token also has a per-username one
+    @app.post("/register", response_model=UserResponse, dependencies=[Depends(limit_login_by_ip)])
+    async def register(user: UserCreate, idempotency_key: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+        logging.debug(f"Registering user: {user.username}")
+        # A retried registration (same Idempotency-Key and body) gets the original response
+        # instead of "Username already registered". There's no user yet, so keys are scoped
+        # by the username: another client's key only collides for the same name.
+        return await idempotency_store.run(
+            idempotency_key, ("register", user.username), "POST /register", fingerprint(user.username, user.password),
+            lambda: create_user(user, db),
+        )
 
-        # Debug: Check all users currently in the database
-        all_users = db.query(User).all()
-        print(f"Current users in the database: {[u.username for u in all_users]}")
+    async def create_user(user: UserCreate, db: AsyncSession) -> Response:
+        if await lookup_user(db, user.username):
+            raise HTTPException(status_code=400, detail="Username already registered")
 
-        db_user = db.query(User).filter(User.username == user.username).first()
-        if db_user:
+        # bcrypt runs on the password worker pool, off the event loop and request threadpool
+        started = time.perf_counter()
+        hashed_password = await hash_password_async(user.password)
+        observe_bcrypt("hash", time.perf_counter() - started)
+        # The directory hands out the id; the stable hash of it picks the user's shard
+        entry = UserDirectory(username=user.username)
+        db.add(entry)
+        try:
+            await db.flush()
+        except IntegrityError:
             raise HTTPException(status_code=400, detail="Username already registered")
+        entry.shard = placement_shard(entry.id)
+        new_user = User(id=entry.id, username=user.username, password_hash=hashed_password)
+        async with shard_session(db, entry.shard) as shard_db:
+            shard_db.add(new_user)
+            if shard_db is not db:
+                await shard_db.commit()
+        await db.commit()  # committing the directory entry is what makes the user exist
+        return Response(UserResponse.model_validate(new_user).model_dump_json(), media_type="application/json")
 
-        hashed_password = hash_password(user.password)
-        new_user = User(username=user.username, password_hash=hashed_password)
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-        return new_user
-
-    @app.post("/token", response_model=Token)
-    def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-        db_user = db.query(User).filter(User.username == form_data.username).first()
-        if not db_user:
+    @app.post("/token", response_model=Token, dependencies=[Depends(limit_login_by_ip)])
+    async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+        # Checked before any DB or bcrypt work
+        await rate_limiter.hit("login_user", form_data.username.lower())
+        entry = await lookup_user(db, form_data.username)
+        if not entry:
             logging.info(f"User not found: {form_data.username}")
             raise HTTPException(status_code=401, detail="Invalid username or password")
-        if not verify_password(form_data.password, db_user.password_hash):
-            logging.info(f"Invalid password for user: {form_data.username}")
-            raise HTTPException(status_code=401, detail="Invalid username or password")
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": db_user.username}, expires_delta=access_token_expires
-        )
-        return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+        async with shard_session(db, entry.shard) as shard_db:
+            db_user = await shard_db.get(User, entry.id)
+            if db_user is None:
+                logging.warning(f"User {form_data.username} missing from shard {entry.shard}")
+                raise HTTPException(status_code=401, detail="Invalid username or password")
+            started = time.perf_counter()
+            valid, new_hash = await verify_and_update_password(form_data.password, db_user.password_hash)
+            observe_bcrypt("verify", time.perf_counter() - started)
+            if not valid:
+                logging.info(f"Invalid password for user: {form_data.username}")
+                raise HTTPException(status_code=401, detail="Invalid username or password")
+            if new_hash is not None:
+                # Stored hash used an outdated bcrypt cost; upgrade it now that we know the password
+                db_user.password_hash = new_hash
+                await shard_db.commit()
+        return issue_tokens(db_user.username)
+
+    @app.post("/token/refresh", response_model=Token, dependencies=[Depends(limit_login_by_ip)])
+    async def refresh(request: RefreshRequest, db: AsyncSession = Depends(get_db)):
+        claims = verify_token(request.refresh_token, "refresh")
+        # Refresh tokens are single use: claimed before the first await, so of concurrent
+        # replays exactly one gets through
+        if not revocations.claim(claims["jti"], claims["exp"]):
+            raise credentials_exception()
+        # The only DB hit in the token flow besides login: refuse refreshes for deleted users
+        if await lookup_user(db, claims["sub"]) is None:
+            raise credentials_exception()
+        return issue_tokens(claims["sub"])
+
+    @app.post("/logout", status_code=204)
+    async def logout(request: Optional[LogoutRequest] = None, token: str = Depends(oauth2_scheme)):
+        verify_token(token)
+        revoke_token(token)
+        if request is not None and request.refresh_token:
+            revoke_token(request.refresh_token, "refresh")
\ No newline at end of file
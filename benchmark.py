@@ -0,0 +1,227 @@
+# benchmark.py
+"""Load test / latency benchmark for the todo API.
+
+Seeds a throw-away SQLite database, drives the real main.app in-process through
+httpx's ASGI transport (no sockets) with concurrent async clients, and reports
+throughput and p50/p95/p99 latency per endpoint.
+
+    python benchmark.py --users 50 --todos-per-user 200 --concurrency 32
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json --tolerance 0.15
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ENDPOINTS = ["token", "list_todos", "list_todos_page", "read_todo", "create_todo", "toggle_status"]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def seed(users, todos_per_user, password):
+    # Imported lazily: DATABASE_URL has to be set before database.py is imported
+    from sqlalchemy import insert
+    from database import SessionLocal, Todo, User, UserDirectory
+    from passwords import get_pwd_context
+
+    password_hash = get_pwd_context().hash(password)  # one hash shared by every seeded user
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        # Everything on shard 0: the directory entries point there
+        user_ids = db.scalars(
+            insert(UserDirectory).returning(UserDirectory.id, sort_by_parameter_order=True),
+            [{"username": f"bench{i}", "shard": 0} for i in range(users)],
+        ).all()
+        db.execute(insert(User), [
+            {"id": user_id, "username": f"bench{i}", "password_hash": password_hash} for i, user_id in enumerate(user_ids)
+        ])
+        rows = [
+            {
+                "name": f"Todo {n}",
+                "description": f"Benchmark todo {n} of user {user_id}",
+                "due_date": now + timedelta(hours=random.randint(-240, 240)),
+                "status": random.random() < 0.3,
+                "owner_id": user_id,
+            }
+            for user_id in user_ids
+            for n in range(todos_per_user)
+        ]
+        for start in range(0, len(rows), 5000):
+            db.execute(insert(Todo), rows[start:start + 5000])
+        db.commit()
+        todo_ids = {user_id: [] for user_id in user_ids}
+        for todo_id, owner_id in db.execute(Todo.__table__.select().with_only_columns(Todo.id, Todo.owner_id)):
+            todo_ids[owner_id].append(todo_id)
+    return [(f"bench{i}", user_id, todo_ids[user_id]) for i, user_id in enumerate(user_ids)]
+
+
+def login_headers(users):
+    """One token per simulated user, minted up front and reused like a real client would,
+    so the token and user caches are measured warm rather than cold on every request."""
+    from auth import ACCESS_TOKEN_EXPIRE_MINUTES, create_access_token
+
+    return [
+        (username, user_id, todo_ids,
+         {"Authorization": f"Bearer {create_access_token({'sub': username}, timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))}"})
+        for username, user_id, todo_ids in users
+    ]
+
+
+def build_requests(endpoint, user, password):
+    username, _, todo_ids, headers = user
+    if endpoint == "token":
+        return "POST", "/token", {"data": {"username": username, "password": password}}
+    if endpoint == "list_todos":
+        return "GET", "/todos/?limit=1000", {"headers": headers}
+    if endpoint == "list_todos_page":
+        return "GET", "/todos/?limit=50&status=false&sort=due_date", {"headers": headers}
+    if endpoint == "read_todo":
+        return "GET", f"/todos/{random.choice(todo_ids)}", {"headers": headers}
+    if endpoint == "create_todo":
+        body = {"name": "Bench create", "description": "created by benchmark", "due_date": "2030-01-01T00:00:00"}
+        return "POST", "/todos/", {"headers": headers, "json": body}
+    if endpoint == "toggle_status":
+        return "PUT", f"/todos/{random.choice(todo_ids)}/toggle_status", {"headers": headers}
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+async def run_endpoint(client, endpoint, users, password, requests, concurrency):
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, url, kwargs = build_requests(endpoint, random.choice(users), password)
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+async def run_benchmark(args):
+    import httpx
+    from database import init_db
+    from main import app
+
+    init_db()
+    users = login_headers(seed(args.users, args.todos_per_user, args.password))
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    # ASGITransport does not send lifespan events, so run the app's lifespan around the run
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for endpoint in args.endpoints:
+                requests = args.token_requests if endpoint == "token" else args.requests
+                # Warm up pools, caches and the writer thread before measuring
+                await run_endpoint(client, endpoint, users, args.password, min(requests, args.concurrency), args.concurrency)
+                results[endpoint] = await run_endpoint(client, endpoint, users, args.password, requests, args.concurrency)
+                print_row(endpoint, results[endpoint])
+    return {
+        "meta": {
+            "created": datetime.utcnow().isoformat(timespec="seconds"),
+            "users": args.users,
+            "todos_per_user": args.todos_per_user,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+        },
+        "results": results,
+    }
+
+
+def print_row(endpoint, row):
+    print(
+        f"{endpoint:<18} {row['requests']:>7} {row['errors']:>6} {row['throughput_rps']:>10} "
+        f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}"
+    )
+
+
+def compare(current, baseline, tolerance):
+    """Return a list of regressions: throughput down or p95 up by more than `tolerance`."""
+    regressions = []
+    for endpoint, row in current["results"].items():
+        base = baseline["results"].get(endpoint)
+        if base is None:
+            continue
+        if base["throughput_rps"] and row["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{endpoint}: throughput {base['throughput_rps']} -> {row['throughput_rps']} req/s")
+        if base["p95_ms"] and row["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{endpoint}: p95 {base['p95_ms']} -> {row['p95_ms']} ms")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the todo API in-process")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--todos-per-user", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000, help="measured requests per endpoint")
+    parser.add_argument("--token-requests", type=int, default=50, help="measured /token requests (bcrypt bound)")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--password", default="benchmark-password")
+    parser.add_argument("--save", metavar="PATH", help="write results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    db_dir = tempfile.mkdtemp(prefix="todo-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+    # Measure the endpoints themselves, not 429s from a handful of benchmark users
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+
+    print(f"{'endpoint':<18} {'reqs':>7} {'errors':>6} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    try:
+        report = asyncio.run(run_benchmark(args))
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
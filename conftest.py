@@ -0,0 +1,124 @@
+# conftest.py
+"""Test harness: one schema per worker, one rolled-back transaction per test.
+
+The schema is created once per pytest process (each pytest-xdist worker gets its own
+SQLite file, see testing.py), and every test runs inside an outer transaction that is
+rolled back afterwards; the app's sessions join it through SAVEPOINTs, so their commits
+never reach the file. Those tests write through the request session instead of the
+SQLite writer thread, which can't join the test's transaction.
+
+Tests marked @pytest.mark.committed run like production instead: writes go through
+the writer thread and commit, other connections (sync engines, background jobs) see
+them, and the tables are emptied afterwards. The write paths are tested this way.
+
+bcrypt runs at its minimum cost on a thread, and all requests share one event loop.
+"""
+import itertools
+import shutil
+import time
+from collections import defaultdict
+
+# First: sets up the environment the app modules read at import
+from testing import TEST_DB_DIR, app, async_engine, client, empty_tables, engine, override_get_db, register_and_login, use_db
+
+import pytest
+from anyio.from_thread import start_blocking_portal
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import writer
+from auth import user_cache
+from database import Base
+from idempotency import idempotency_store
+from ratelimit import rate_limiter
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "committed: commit for real through the SQLite writer; tables are emptied afterwards")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def portal():
+    """One event loop for every request of the session, instead of one per request."""
+    Base.metadata.create_all(bind=engine)
+    with start_blocking_portal() as portal:
+        client.portal = portal
+        yield portal
+        client.portal = None
+    writer.stop_writers()
+    engine.dispose()
+    shutil.rmtree(TEST_DB_DIR, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def reset_tables(request, portal, monkeypatch):
+    user_cache.clear()
+    rate_limiter.reset()
+    idempotency_store.clear()
+    if request.node.get_closest_marker("committed"):
+        yield
+        empty_tables()
+        return
+
+    monkeypatch.setattr(writer, "SQLITE_WRITER", False)
+    connection = portal.call(async_engine.connect)
+    transaction = portal.call(connection.begin)
+
+    async def transactional_db():
+        async with AsyncSession(bind=connection, join_transaction_mode="create_savepoint",
+                                autoflush=False, expire_on_commit=False) as db:
+            yield db
+
+    use_db(transactional_db)
+    try:
+        yield
+    finally:
+        use_db(override_get_db)
+        portal.call(transaction.rollback)
+        portal.call(connection.close)
+
+
+# Users and pre-authenticated clients
+
+_user_numbers = itertools.count(1)
+
+@pytest.fixture
+def unique_user():
+    n = next(_user_numbers)
+    return {"username": f"testuser{n}", "password": f"testpassword{n}"}
+
+@pytest.fixture
+def make_client(portal):
+    """make_client() -> a TestClient already logged in as a new user (see client.user)."""
+    def make(username: str = None, password: str = "testpassword"):
+        user = {"username": username or f"testuser{next(_user_numbers)}", "password": password}
+        authed = TestClient(app, headers=register_and_login(user))
+        authed.portal = portal
+        authed.user = user
+        return authed
+    return make
+
+@pytest.fixture
+def auth_client(make_client):
+    return make_client()
+
+
+# Timing report: where the suite's time goes, per phase
+
+_durations = defaultdict(float)
+_isolation = defaultdict(int)
+_session_started = time.perf_counter()
+
+def pytest_runtest_logreport(report):
+    _durations[report.when] += report.duration
+    if report.when == "setup":
+        _isolation["committed" if "committed" in report.keywords else "rolled back"] += 1
+
+def pytest_terminal_summary(terminalreporter):
+    if not _durations:
+        return
+    phases = ", ".join(f"{when} {_durations[when]:.2f}s" for when in ("setup", "call", "teardown"))
+    isolation = ", ".join(f"{count} {mode}" for mode, count in sorted(_isolation.items()))
+    terminalreporter.write_sep("-", "test timing")
+    terminalreporter.write_line(f"{phases}; wall {time.perf_counter() - _session_started:.2f}s ({isolation})")
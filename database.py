@@ -1,18 +1,173 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey
+import os
+import tempfile
+import hashlib
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from sqlalchemy import create_engine, event, func, inspect, text, Column, Integer, String, Text, Date, DateTime, Boolean, ForeignKey, Index
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Any SQLAlchemy URL; the async engine swaps in the matching async driver
+# (sqlite -> aiosqlite, postgresql -> asyncpg) unless ASYNC_DATABASE_URL is given.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./todo.db")
+# Horizontal partitioning: users (with their todos) are spread over these databases.
+# Shard 0 is DATABASE_URL and also holds the user directory; by default it's the only one.
+SHARD_URLS = [DATABASE_URL] + [url.strip() for url in os.getenv("EXTRA_SHARD_URLS", "").split(",") if url.strip()]
+
+# Connection pool settings (ignored for in-memory SQLite, which uses a single connection)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+def _split_drivername(url):
+    backend, _, driver = url.drivername.partition("+")
+    return ("postgresql" if backend == "postgres" else backend), driver
+
+def sync_url(url: str) -> str:
+    url = make_url(url)
+    backend, driver = _split_drivername(url)
+    if not driver or driver in ASYNC_DRIVERS.values():
+        url = url.set(drivername=backend)
+    return url.render_as_string(hide_password=False)
+
+def async_url(url: str) -> str:
+    url = make_url(url)
+    backend, driver = _split_drivername(url)
+    if backend in ASYNC_DRIVERS and driver != ASYNC_DRIVERS[backend]:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return url.render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", async_url(DATABASE_URL))
+
+def is_sqlite(url) -> bool:
+    return _split_drivername(make_url(url))[0] == "sqlite"
+
+def engine_options(url: str) -> dict:
+    url = make_url(url)
+    backend, driver = _split_drivername(url)
+    if backend == "sqlite":
+        options = {"connect_args": {"check_same_thread": False}}
+        if url.database in (None, "", ":memory:"):
+            return options
+        if driver == "aiosqlite":
+            # aiosqlite defaults to NullPool (a new connection + thread per checkout)
+            options["poolclass"] = AsyncAdaptedQueuePool
+    else:
+        options = {"pool_pre_ping": True}
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+    return options
+
+# Production SQLite profile applied to every new connection: WAL lets readers run
+# alongside the (single) writer, and synchronous=NORMAL only fsyncs at checkpoints.
+SQLITE_TUNING = os.getenv("SQLITE_TUNING", "1") == "1"
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "cache_size": -int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536")),  # negative = KiB
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": "MEMORY",
+}
+
+def apply_sqlite_pragmas(engine):
+    engine = getattr(engine, "sync_engine", engine)  # accept AsyncEngine too
+    if not SQLITE_TUNING or engine.dialect.name != "sqlite":
+        return
 
-DATABASE_URL = "sqlite:///./todo.db"
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# The options always come from the URL the engine is created with: a sync engine for
+# "sqlite+aiosqlite://..." must not get the async pool class
+def open_sync_engine(url: str):
+    url = sync_url(url)
+    sync_engine = create_engine(url, **engine_options(url))
+    apply_sqlite_pragmas(sync_engine)
+    return sync_engine
+
+def open_async_engine(url: str):
+    url = async_url(url)
+    new_engine = create_async_engine(url, **engine_options(url))
+    apply_sqlite_pragmas(new_engine)
+    return new_engine
+
+# The sync engine is kept for schema management and scripts; request handlers use the async one
+engine = open_sync_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = open_async_engine(ASYNC_DATABASE_URL)
+# expire_on_commit=False: handlers return objects after commit without a refresh round-trip
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+@dataclass
+class Shard:
+    index: int
+    url: str
+    engine: object
+    async_engine: object
+    sessions: async_sessionmaker
+
+def _open_shard(index: int, url: str) -> Shard:
+    sync_engine = open_sync_engine(url)
+    shard_async_engine = open_async_engine(url)
+    return Shard(index, url, sync_engine, shard_async_engine, async_sessionmaker(
+        shard_async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False))
+
+shards = [Shard(0, DATABASE_URL, engine, async_engine, AsyncSessionLocal)] + [
+    _open_shard(index, url) for index, url in enumerate(SHARD_URLS[1:], start=1)
+]
+
+def placement_shard(user_id: int, count: Optional[int] = None) -> int:
+    """Shard for a new user: a stable hash of the id (not Python's per-process hash())."""
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % (count or len(shards))
+
+def shard_index(bind) -> Optional[int]:
+    """Index of the shard behind an engine/connection, None for a database outside SHARD_URLS."""
+    url = sync_url(bind.engine.url.render_as_string(hide_password=False))
+    return next((shard.index for shard in shards if sync_url(shard.url) == url), None)
+
+@asynccontextmanager
+async def shard_session(db: AsyncSession, shard: int):
+    """Session on `shard`, given a session on the directory's database (shard 0). Shard 0
+    users just reuse it, so a single-database setup never opens a second session."""
+    if shard == 0:
+        yield db
+        return
+    async with shards[shard].sessions() as shard_db:
+        yield shard_db
+
+async def dispose_shards():
+    for shard in shards:
+        await shard.async_engine.dispose()
+
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()  # Or TestingSessionLocal if it's for testing
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()  # Make sure this is always executed to close the connection
 
 
 # Database Models
@@ -22,6 +177,9 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     password_hash = Column(String)
+    # Bumped by every todo mutation of this user; drives the ETag of GET /todos/
+    todos_version = Column(Integer, nullable=False, default=0, server_default="0")
+    todos_updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, server_default=func.current_timestamp())
 
     todos = relationship("Todo", back_populates="owner")
 
@@ -34,12 +192,214 @@ class Todo(Base):
     due_date = Column(DateTime)
     status = Column(Boolean, default=False)
     owner_id = Column(Integer, ForeignKey('users.id'))
+    # Per-row version for ETags and If-Match optimistic concurrency
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                        server_default=func.current_timestamp())
+    # Owner's todos_version at this row's last change; /todos/changes pages by (revision, id)
+    revision = Column(Integer, nullable=False, default=0, server_default="0")
 
     owner = relationship("User", back_populates="todos")
 
-# Initialize the database
+    # Composite indexes backing the filtered/keyset-paginated listing in todo.py.
+    # SQLite appends the rowid (id) to every index, so these also cover the id tiebreaker.
+    __table_args__ = (
+        Index("ix_todos_owner_status_due_date", "owner_id", "status", "due_date"),
+        Index("ix_todos_owner_due_date", "owner_id", "due_date"),
+        Index("ix_todos_owner_revision", "owner_id", "revision"),
+        # Across all owners, for the due-date scheduler's (due_date, id) window scans
+        Index("ix_todos_due_date", "due_date"),
+        # Never hand a deleted todo's id to a new one: ETags ("t{id}.{version}") and the
+        # change feed identify todos by id
+        {"sqlite_autoincrement": True},
+    )
+
+class TodoTombstone(Base):
+    # Deleted todos are removed from `todos` and leave a tombstone here, so the change
+    # feed can report deletes without every other query filtering out soft-deleted rows.
+    __tablename__ = 'todo_tombstones'
+
+    # Keyed by owner too: a user moved to another shard brings tombstones whose ids may
+    # collide with other users' there
+    owner_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    todo_id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_todo_tombstones_owner_revision", "owner_id", "revision"),
+    )
+
+# Per-user counters behind GET /todos/stats, maintained by triggers on todos (so every
+# write path, including bulk Core statements and imports, keeps them current) and
+# periodically recomputed by stats.reconcile_stats.
+class TodoStats(Base):
+    __tablename__ = 'todo_stats'
+
+    owner_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    done = Column(Integer, nullable=False, default=0)
+
+class TodoDueCount(Base):
+    # Open todos per due day (UTC); overdue / due today / this week sum a few of these rows
+    __tablename__ = 'todo_due_counts'
+
+    owner_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    due_day = Column(Date, primary_key=True)
+    open_count = Column(Integer, nullable=False, default=0)
+
+_SQLITE_STATS_REMOVE = (
+    "UPDATE todo_stats SET total = total - 1, done = done - coalesce(old.status, 0) WHERE owner_id = old.owner_id; "
+    "UPDATE todo_due_counts SET open_count = open_count - 1 "
+    "WHERE owner_id = old.owner_id AND due_day = date(old.due_date) AND NOT coalesce(old.status, 0); "
+)
+_SQLITE_STATS_ADD = (
+    "INSERT INTO todo_stats (owner_id, total, done) VALUES (new.owner_id, 1, coalesce(new.status, 0)) "
+    "ON CONFLICT (owner_id) DO UPDATE SET total = total + 1, done = done + excluded.done; "
+    "INSERT INTO todo_due_counts (owner_id, due_day, open_count) "
+    "SELECT new.owner_id, date(new.due_date), 1 WHERE new.due_date IS NOT NULL AND NOT coalesce(new.status, 0) "
+    "ON CONFLICT (owner_id, due_day) DO UPDATE SET open_count = open_count + 1; "
+)
+SQLITE_STATS_DDL = [
+    f"CREATE TRIGGER IF NOT EXISTS todo_stats_ai AFTER INSERT ON todos BEGIN {_SQLITE_STATS_ADD}END",
+    f"CREATE TRIGGER IF NOT EXISTS todo_stats_ad AFTER DELETE ON todos BEGIN {_SQLITE_STATS_REMOVE}END",
+    f"CREATE TRIGGER IF NOT EXISTS todo_stats_au AFTER UPDATE OF status, due_date, owner_id ON todos "
+    f"BEGIN {_SQLITE_STATS_REMOVE}{_SQLITE_STATS_ADD}END",
+]
+POSTGRES_STATS_DDL = [
+    """CREATE OR REPLACE FUNCTION todo_stats_maintain() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE todo_stats SET total = total - 1, done = done - (CASE WHEN coalesce(OLD.status, false) THEN 1 ELSE 0 END)
+            WHERE owner_id = OLD.owner_id;
+            IF OLD.due_date IS NOT NULL AND NOT coalesce(OLD.status, false) THEN
+                UPDATE todo_due_counts SET open_count = open_count - 1
+                WHERE owner_id = OLD.owner_id AND due_day = OLD.due_date::date;
+            END IF;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO todo_stats (owner_id, total, done)
+            VALUES (NEW.owner_id, 1, CASE WHEN coalesce(NEW.status, false) THEN 1 ELSE 0 END)
+            ON CONFLICT (owner_id) DO UPDATE SET total = todo_stats.total + 1, done = todo_stats.done + excluded.done;
+            IF NEW.due_date IS NOT NULL AND NOT coalesce(NEW.status, false) THEN
+                INSERT INTO todo_due_counts (owner_id, due_day, open_count) VALUES (NEW.owner_id, NEW.due_date::date, 1)
+                ON CONFLICT (owner_id, due_day) DO UPDATE SET open_count = todo_due_counts.open_count + 1;
+            END IF;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS todo_stats_maintain ON todos",
+    "CREATE TRIGGER todo_stats_maintain AFTER INSERT OR DELETE OR UPDATE OF status, due_date, owner_id ON todos "
+    "FOR EACH ROW EXECUTE FUNCTION todo_stats_maintain()",
+]
+
+def create_stats_triggers(connection):
+    ddl = {"sqlite": SQLITE_STATS_DDL, "postgresql": POSTGRES_STATS_DDL}.get(connection.dialect.name, [])
+    for statement in ddl:
+        connection.execute(text(statement))
+
+class UserDirectory(Base):
+    # Which shard holds each user; lives on shard 0. Its id is the user's id on every
+    # shard, so ids stay unique across shards.
+    __tablename__ = 'user_directory'
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String, nullable=False, unique=True, index=True)
+    shard = Column(Integer, nullable=False, default=0)
+
+class SchedulerState(Base):
+    # Per-job start of scheduler.py's due-date window: todos due earlier are never notified.
+    # Which todos in the window were notified is in scheduler_notifications.
+    __tablename__ = 'scheduler_state'
+
+    job = Column(String, primary_key=True)
+    due_date = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SchedulerNotification(Base):
+    # Todos a due-date job has notified, and for which due date: moving a todo to another
+    # due date makes it due for a notification again. Pruned as the job's window moves on.
+    __tablename__ = 'scheduler_notifications'
+
+    job = Column(String, primary_key=True)
+    todo_id = Column(Integer, primary_key=True)
+    due_date = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_scheduler_notifications_job_due_date", "job", "due_date"),
+    )
+
+# Full-text search over name + description. SQLite: an external-content FTS5 table
+# (no second copy of the text) kept in sync by triggers; rowid is todos.id.
+# Postgres: a generated, weighted tsvector column with a GIN index.
+SQLITE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts USING fts5("
+    "name, description, content='todos', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_ai AFTER INSERT ON todos BEGIN "
+    "INSERT INTO todos_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_ad AFTER DELETE ON todos BEGIN "
+    "INSERT INTO todos_fts(todos_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END",
+    # Only text changes touch the index; toggles and version bumps don't
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_au AFTER UPDATE OF name, description ON todos BEGIN "
+    "INSERT INTO todos_fts(todos_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO todos_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+]
+POSTGRES_SEARCH_DDL = [
+    "ALTER TABLE todos ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'B')) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_todos_search_vector ON todos USING GIN (search_vector)",
+]
+
+def create_search_index(connection):
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        existed = inspect(connection).has_table("todos_fts")
+        for ddl in SQLITE_SEARCH_DDL:
+            connection.execute(text(ddl))
+        if not existed:
+            # Index rows written before the FTS table existed
+            connection.execute(text("INSERT INTO todos_fts(todos_fts) VALUES ('rebuild')"))
+    elif dialect == "postgresql":
+        for ddl in POSTGRES_SEARCH_DDL:
+            connection.execute(text(ddl))
+
+def drop_search_index(connection):
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS todos_fts"))  # the triggers go with todos
+
+event.listen(Todo.__table__, "after_create", lambda target, connection, **kw: create_search_index(connection))
+event.listen(Todo.__table__, "after_create", lambda target, connection, **kw: create_stats_triggers(connection))
+event.listen(Todo.__table__, "before_drop", lambda target, connection, **kw: drop_search_index(connection))
+
+# Initialize the database: the schema is versioned in migrations.py
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    from migrations import upgrade  # imports this module
+    for shard in shards:
+        upgrade(shard.engine)
+
+# Set by serve.py once it has initialised the database before starting workers
+DB_INIT_LOCK = os.getenv("DB_INIT_LOCK", os.path.join(tempfile.gettempdir(), "todo-db-init.lock"))
+
+@contextmanager
+def db_init_lock():
+    """Cross-process lock around schema changes so concurrent workers/CLI runs don't race on DDL."""
+    with open(DB_INIT_LOCK, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+def init_db_once():
+    """init_db() for worker startup: skipped when the launcher already ran it."""
+    if os.getenv("TODO_DB_INITIALIZED") == "1":
+        return
+    with db_init_lock():
+        init_db()
 
 if __name__ == "__main__":
     init_db()
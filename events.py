@@ -0,0 +1,233 @@
+# events.py
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Set
+
+from metrics import Counter, Gauge, registry
+
+# Per-subscriber buffer; a client that falls this far behind is disconnected and
+# is expected to reconnect and catch up through /todos/changes.
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("EVENTS_SUBSCRIBER_QUEUE_SIZE", "256"))
+HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+# "memory" delivers within this process only; "sqlite" shares events between
+# uvicorn workers through a small SQLite file acting as a local broker.
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "memory")
+EVENTS_BROKER_PATH = os.getenv("EVENTS_BROKER_PATH", "./events.db")
+BROKER_POLL_SECONDS = float(os.getenv("EVENTS_BROKER_POLL_SECONDS", "0.1"))
+BROKER_RETENTION_SECONDS = float(os.getenv("EVENTS_BROKER_RETENTION_SECONDS", "300"))
+
+logger = logging.getLogger(__name__)
+
+subscribers_gauge = registry.register(Gauge(
+    "todo_event_subscribers", "Open SSE/WebSocket todo event subscriptions"))
+events_published = registry.register(Counter(
+    "todo_events_published_total", "Todo change events published", ("type",)))
+subscribers_dropped = registry.register(Counter(
+    "todo_event_subscribers_dropped_total", "Subscribers disconnected for falling behind"))
+
+DROPPED = object()
+
+
+class Subscriber:
+    def __init__(self, user_id: int, maxsize: int = SUBSCRIBER_QUEUE_SIZE):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.loop = asyncio.get_running_loop()
+        self.dropped = False
+
+    def offer(self, message):
+        # Always runs on the subscriber's own loop
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped = True
+            subscribers_dropped.inc()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(DROPPED)
+
+    async def get(self, timeout: float):
+        """Next message, None on heartbeat timeout, DROPPED if we fell behind."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventHub:
+    """Fans todo change events out to every open stream of the affected user."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or InProcessBackend()
+        self.backend.bind(self.deliver)
+        self._subscribers: Dict[int, Set[Subscriber]] = {}
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    async def start(self):
+        await self.backend.start()
+
+    async def stop(self):
+        await self.backend.stop()
+
+    def subscribe(self, user_id: int) -> Subscriber:
+        subscriber = Subscriber(user_id)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+        subscribers_gauge.inc()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id)
+            if subscribers is None or subscriber not in subscribers:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.user_id]
+        subscribers_gauge.dec()
+
+    async def publish(self, user_id: int, event: dict):
+        """Called by the todo handlers after their write has committed."""
+        events_published.inc(event.get("type", ""))
+        await self.backend.publish(user_id, event)
+
+    def deliver(self, user_id: int, event: dict):
+        with self._lock:
+            self._sequence += 1
+            message = (self._sequence, event)
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscriber in subscribers:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if subscriber.loop is running:
+                subscriber.offer(message)
+            elif not subscriber.loop.is_closed():
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, message)
+
+
+class EventBackend:
+    """Transport between publishers and hubs. Implementations call deliver(user_id, event)
+    on every process's hub, including the publisher's own."""
+
+    deliver = None
+
+    def bind(self, deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id: int, event: dict):
+        raise NotImplementedError
+
+
+class InProcessBackend(EventBackend):
+    async def publish(self, user_id: int, event: dict):
+        if self.deliver is not None:
+            self.deliver(user_id, event)
+
+
+class SQLiteBrokerBackend(EventBackend):
+    """Stand-in for a real broker (Redis, NATS...): publishers append to a shared
+    SQLite file and every worker tails it from the rowid it has already seen."""
+
+    def __init__(self, path: str = EVENTS_BROKER_PATH, poll_interval: float = BROKER_POLL_SECONDS):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._task = None
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+                "payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    async def start(self):
+        last_id = await asyncio.to_thread(self._max_id)
+        self._task = asyncio.create_task(self._poll(last_id))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def publish(self, user_id: int, event: dict):
+        await asyncio.to_thread(self._insert, user_id, json.dumps(event, default=str))
+
+    def _insert(self, user_id, payload):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO events (user_id, payload, created_at) VALUES (?, ?, ?)",
+                (user_id, payload, time.time()),
+            )
+
+    def _max_id(self):
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _read_after(self, last_id):
+        return self._connect().execute(
+            "SELECT id, user_id, payload FROM events WHERE id > ? ORDER BY id LIMIT 1000", (last_id,)
+        ).fetchall()
+
+    def _prune(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM events WHERE created_at < ?", (time.time() - BROKER_RETENTION_SECONDS,))
+
+    async def _poll(self, last_id):
+        last_prune = time.monotonic()
+        while True:
+            rows = []
+            try:
+                rows = await asyncio.to_thread(self._read_after, last_id)
+                for event_id, user_id, payload in rows:
+                    last_id = event_id
+                    self.deliver(user_id, json.loads(payload))
+                if time.monotonic() - last_prune > BROKER_RETENTION_SECONDS:
+                    await asyncio.to_thread(self._prune)
+                    last_prune = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Event broker poll failed")
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+
+def create_backend(name: str = EVENTS_BACKEND) -> EventBackend:
+    if name == "sqlite":
+        return SQLiteBrokerBackend()
+    return InProcessBackend()
+
+
+hub = EventHub(create_backend())
+
+
+def format_sse(sequence: int, event: dict) -> str:
+    return f"id: {sequence}\nevent: {event.get('type', 'message')}\ndata: {json.dumps(event, default=str)}\n\n"
@@ -0,0 +1,96 @@
+# idempotency.py
+import hashlib
+import os
+import secrets
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+from cache import SingleFlight, TTLCache
+from metrics import Counter, registry
+
+# Responses of writes sent with an Idempotency-Key header are kept this long, so a client
+# retrying after a timeout gets the original answer instead of a second write. The store
+# is per process: behind several workers, retries are only deduplicated when they reach
+# the same one.
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+MAX_KEY_LENGTH = 255
+
+replays = registry.register(Counter(
+    "todo_idempotent_replays_total", "Write requests answered from the idempotency store", ("route",)))
+
+
+@dataclass(frozen=True)
+class StoredResponse:
+    fingerprint: str
+    status_code: int
+    body: bytes
+    headers: tuple
+    media_type: Optional[str]
+
+    def replay(self) -> Response:
+        response = Response(self.body, status_code=self.status_code, media_type=self.media_type)
+        response.headers.update(dict(self.headers))
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+
+# Fingerprints are keyed (BLAKE2 as a MAC) with a per-process secret, so a stored one
+# can't be used to check guesses at the request it came from (e.g. a password)
+_FINGERPRINT_KEY = secrets.token_bytes(32)
+
+def fingerprint(*parts) -> str:
+    # Identifies the request a key was first used with; only the hash is kept
+    return hashlib.blake2b(
+        "\x00".join(str(part) for part in parts).encode(), digest_size=16, key=_FINGERPRINT_KEY
+    ).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, maxsize: int = IDEMPOTENCY_MAX_KEYS, ttl: float = IDEMPOTENCY_TTL_SECONDS):
+        self.responses = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flights = SingleFlight()
+
+    async def run(self, key: Optional[str], owner, route: str, request_fingerprint: str,
+                  fn: Callable[[], Awaitable[Response]]) -> Response:
+        """fn() unless `owner` already sent `key` to `route` with an identical request, in
+        which case its stored response is replayed. Concurrent retries wait for the first
+        one. Only 2xx responses are stored; a failed write can simply be retried."""
+        if key is None:
+            return await fn()
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+        store_key = (owner, route, key)
+        stored = self.responses.get(store_key)
+        if stored is None:
+            first = False
+
+            async def execute():
+                nonlocal first
+                first = True
+                response = await fn()
+                if 200 <= response.status_code < 300:
+                    self.responses.set(store_key, StoredResponse(
+                        request_fingerprint, response.status_code, bytes(response.body),
+                        tuple((name, value) for name, value in response.headers.items() if name != "content-length"),
+                        response.media_type,
+                    ))
+                return response
+
+            response = await self._flights.do(store_key, execute)
+            stored = self.responses.get(store_key)
+            if first or stored is None:
+                return response  # our own write, or a concurrent one that failed
+        if stored.fingerprint != request_fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        replays.inc(route)
+        return stored.replay()
+
+    def clear(self):
+        self.responses.clear()
+
+
+idempotency_store = IdempotencyStore()
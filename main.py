@@ -1,16 +1,56 @@
 # main.py
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
-from database import init_db
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import HTMLResponse, ORJSONResponse
+from assets import STATIC_WATCH, ApiGZipMiddleware, GZIP_LEVEL, GZIP_MIN_SIZE, StaticAssets, assets
+from database import dispose_shards, init_db_once
 from todo import router as todo_router
 from auth import add_auth_routes
+from metrics import MetricsMiddleware, router as metrics_router
+from ratelimit import AdmissionControlMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-# Initialize the database
-init_db()
+from passwords import hasher_pool
+from writer import stop_writers
+from events import hub
+from scheduler import SCHEDULER_ENABLED, create_scheduler
+# Per-worker thread pool: sync endpoints/dependencies (anyio) and asyncio.to_thread users
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema setup happens at startup, not import; serve.py runs it once before forking
+    init_db_once()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(THREADPOOL_SIZE, thread_name_prefix="todo"))
+    await hub.start()
+    assets.load()  # front page and static/ served from memory from here on
+    watcher = asyncio.create_task(assets.watch()) if STATIC_WATCH else None
+    # Due-date reminders/overdue sweeps and stats reconcile; one worker per host runs them
+    scheduler = create_scheduler()
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    await scheduler.stop()
+    await hub.stop()
+    stop_writers()
+    await dispose_shards()
+    hasher_pool.shutdown()
 
+# orjson encodes response bodies several times faster than the stdlib json module
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Compresses large JSON bodies; inside admission control so the CPU it takes is counted
+app.add_middleware(ApiGZipMiddleware, minimum_size=GZIP_MIN_SIZE, compresslevel=GZIP_LEVEL)
+# Shed requests still get CORS headers and are counted by MetricsMiddleware
+app.add_middleware(AdmissionControlMiddleware)
 # Fix the CORS issue
 app.add_middleware(
     CORSMiddleware,
@@ -18,16 +58,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified"],
 )
+app.add_middleware(MetricsMiddleware)
 app.include_router(todo_router, prefix="/todos", tags=["todos"])
+app.include_router(metrics_router)
 
-# Serve static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Serve static files from the in-memory asset table (assets.py)
+app.mount("/static", StaticAssets(assets), name="static")
 
 # Root endpoint
 @app.get("/", response_class=HTMLResponse)
-def read_root():
-    return HTMLResponse(content=open("static/index.html").read())
+async def read_root(request: Request):
+    asset, _ = assets.lookup("index.html")
+    if asset is None:  # no bundled client in this deployment
+        return Response("Not Found", status_code=404, media_type="text/plain")
+    return assets.response(asset, request.headers, method=request.method)
 
 # Favicon endpoint
 @app.get("/favicon.ico", include_in_schema=False)
@@ -40,8 +86,6 @@ add_auth_routes(app)
 
 
 if __name__ == "__main__":
-    init_db()  # Only run this when starting the main application server
-    import uvicorn
-    uvicorn.run(app, host="localhost", port=8000)
-
-    print("Initializing database...")
\ No newline at end of file
+    # Single-process development server; use serve.py for multiple workers
+    from serve import main
+    main(["--workers", "1", "--host", "localhost", "--port", "8000"])
\ No newline at end of file
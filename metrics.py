@@ -0,0 +1,267 @@
+# metrics.py
+import logging
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Add a Server-Timing header (app/db/bcrypt/jwt) to every response
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+# Same SQL statement executed this many times in one request is reported as a likely N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: item[0])
+        for label_values, value in items:
+            lines.extend(self._sample_lines(label_values, value))
+        return lines
+
+    def _sample_lines(self, label_values, value):
+        return [f"{self.name}{_format_labels(self.labels, label_values)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value: float):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value: float):
+        with self._lock:
+            counts, total, count = self._values.get(label_values) or ((0,) * len(self.buckets), 0.0, 0)
+            counts = list(counts)  # copy: collect() may be formatting the previous list
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[label_values] = (counts, total + value, count + 1)
+
+    def _sample_lines(self, label_values, value):
+        counts, total, count = value
+        names = self.labels + ("le",)
+        lines = [
+            f"{self.name}_bucket{_format_labels(names, label_values + (bound,))} {bucket_count}"
+            for bound, bucket_count in zip(self.buckets, counts)
+        ]
+        lines.append(f"{self.name}_bucket{_format_labels(names, label_values + ('+Inf',))} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "todo_http_requests_total", "HTTP requests by route, method and status code", ("method", "route", "status")))
+http_latency = registry.register(Histogram(
+    "todo_http_request_duration_seconds", "HTTP request latency by route", ("method", "route")))
+http_in_flight = registry.register(Gauge(
+    "todo_http_requests_in_flight", "HTTP requests currently being served"))
+db_queries = registry.register(Counter(
+    "todo_db_queries_total", "SQL statements executed, by route", ("route",)))
+db_query_time = registry.register(Histogram(
+    "todo_db_query_duration_seconds", "SQL statement execution time", ()))
+db_queries_per_request = registry.register(Histogram(
+    "todo_db_queries_per_request", "SQL statements executed per HTTP request", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100)))
+n_plus_one = registry.register(Counter(
+    "todo_db_n_plus_one_total", "Requests that repeated one SQL statement N_PLUS_ONE_THRESHOLD+ times", ("route",)))
+bcrypt_time = registry.register(Histogram(
+    "todo_bcrypt_duration_seconds", "Password hash/verify time including pool queueing", ("operation",)))
+jwt_decode_time = registry.register(Histogram(
+    "todo_jwt_decode_duration_seconds", "JWT decode and signature verification time", (),
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)))
+
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    query_time: float = 0.0
+    bcrypt_time: float = 0.0
+    jwt_time: float = 0.0
+    statements: Dict[str, int] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record_query(self, statement: str, duration: float):
+        # Writer-thread jobs share this object with the request, hence the lock
+        with self._lock:
+            self.queries += 1
+            self.query_time += duration
+            self.statements[statement] = self.statements.get(statement, 0) + 1
+
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+# SQL instrumentation for every engine (async engines run on a sync Engine underneath)
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    db_query_time.observe(value=duration)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.record_query(statement, duration)
+
+
+def observe_bcrypt(operation: str, duration: float):
+    bcrypt_time.observe(operation, value=duration)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.bcrypt_time += duration
+
+def observe_jwt_decode(duration: float):
+    jwt_decode_time.observe(value=duration)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.jwt_time += duration
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (so streaming responses are not buffered) recording
+    latency, status codes, in-flight requests and per-request SQL counts."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        started = time.perf_counter()
+        status_code = 500
+        http_in_flight.inc()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING:
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + [
+                        (b"server-timing", self._server_timing(stats, time.perf_counter() - started).encode())
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            http_in_flight.dec()
+            request_stats.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path_format", None) or "<unmatched>"
+            method = scope["method"]
+            http_requests.inc(method, route, status_code)
+            http_latency.observe(method, route, value=duration)
+            db_queries.inc(route, amount=stats.queries)
+            db_queries_per_request.observe(route, value=stats.queries)
+            self._check_n_plus_one(route, stats)
+
+    @staticmethod
+    def _server_timing(stats: RequestStats, elapsed: float) -> str:
+        return (
+            f'app;dur={elapsed * 1000:.2f}, '
+            f'db;dur={stats.query_time * 1000:.2f};desc="{stats.queries} queries", '
+            f'bcrypt;dur={stats.bcrypt_time * 1000:.2f}, '
+            f'jwt;dur={stats.jwt_time * 1000:.2f}'
+        )
+
+    @staticmethod
+    def _check_n_plus_one(route: str, stats: RequestStats):
+        if not stats.statements:
+            return
+        statement, count = max(stats.statements.items(), key=lambda item: item[1])
+        if count >= N_PLUS_ONE_THRESHOLD:
+            n_plus_one.inc(route)
+            logger.warning("Possible N+1 on %s: %d x %s", route, count, _WHITESPACE.sub(" ", statement)[:200])
+
+
+router = APIRouter()
+
+@router.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(registry.exposition(), media_type="text/plain; version=0.0.4")
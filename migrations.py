@@ -0,0 +1,438 @@
+# migrations.py
+"""Versioned schema migrations for the todo database.
+
+    python migrations.py status            # applied / pending migrations
+    python migrations.py upgrade [--to N]  # apply pending migrations
+    python migrations.py indexes           # compare live indexes with the models
+
+Each command runs against every shard in turn (see database.SHARD_URLS).
+
+Every migration is written to be safe on databases that already have some of its
+changes (older installs were created with create_all), and is recorded in the
+schema_migrations table once it has run. Index builds use CREATE INDEX CONCURRENTLY
+on Postgres; data backfills run in small batches, each its own short transaction,
+so the writer lock is never held for long on a big table.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from sqlalchemy import (
+    Boolean, Column, Date, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, Text, func, inspect, select, text,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.orm import Session
+
+from database import Base, create_search_index, create_stats_triggers, db_init_lock, engine as default_engine, shard_index, shards
+
+BACKFILL_BATCH_SIZE = int(os.getenv("MIGRATION_BACKFILL_BATCH_SIZE", "5000"))
+# Pause between backfill batches so queued application writes get the lock in between
+BACKFILL_PAUSE_SECONDS = float(os.getenv("MIGRATION_BACKFILL_PAUSE_SECONDS", "0.01"))
+
+# Constant default for NOT NULL timestamp columns added to existing tables (SQLite can't
+# ADD COLUMN with CURRENT_TIMESTAMP); existing rows are backfilled afterwards.
+UNSET_TIMESTAMP = "1970-01-01 00:00:00"
+
+logger = logging.getLogger(__name__)
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    upgrade: Callable
+
+
+MIGRATIONS: List[Migration] = []
+
+def migration(version: int, name: str):
+    def register(fn):
+        MIGRATIONS.append(Migration(version, name, fn))
+        return fn
+    return register
+
+
+# Helpers for migration scripts
+
+def has_column(engine, table: str, column: str) -> bool:
+    return any(col["name"] == column for col in inspect(engine).get_columns(table))
+
+def add_column(engine, table: str, column: str, ddl: str):
+    if not has_column(engine, table, column):
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+def drop_column(engine, table: str, column: str):
+    # Needs SQLite 3.35+; the column must not be indexed or part of a constraint
+    if has_column(engine, table, column):
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+
+def create_index(engine, name: str, table: str, columns: List[str], unique: bool = False):
+    """Create an index if missing, without blocking writes where the database allows it."""
+    if any(index["name"] == name for index in inspect(engine).get_indexes(table)):
+        return
+    unique_sql = "UNIQUE " if unique else ""
+    if engine.dialect.name == "postgresql":
+        # CONCURRENTLY can't run inside a transaction block
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+    else:
+        # SQLite has no online index build; it holds the write lock for the (fast, sequential) build
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+def backfill(engine, table: str, assignments: str, where: str, params: Optional[dict] = None,
+             batch_size: int = BACKFILL_BATCH_SIZE, pause: float = BACKFILL_PAUSE_SECONDS) -> int:
+    """UPDATE rows matching `where` in primary-key batches, one short transaction each."""
+    statement = text(
+        f"UPDATE {table} SET {assignments} WHERE id IN "
+        f"(SELECT id FROM {table} WHERE {where} ORDER BY id LIMIT :batch_size)"
+    )
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            updated = conn.execute(statement, {**(params or {}), "batch_size": batch_size}).rowcount
+        total += updated
+        if updated < batch_size:
+            return total
+        time.sleep(pause)
+
+
+# Migration scripts, in order. Never edit one that has shipped; add a new one instead.
+
+# The schema as it was before migrations existed. Frozen here rather than taken from the
+# models (whose todos table now carries more columns, indexes and triggers), so every
+# later migration finds what it expects, on a fresh database as on an old one.
+baseline = MetaData()
+Table(
+    "users", baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("username", String, unique=True, index=True),
+    Column("password_hash", String),
+)
+Table(
+    "todos", baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, index=True),
+    Column("description", Text),
+    Column("due_date", DateTime),
+    Column("status", Boolean),
+    Column("owner_id", Integer, ForeignKey("users.id")),
+)
+
+@migration(1, "initial users and todos tables")
+def _initial(engine):
+    baseline.create_all(bind=engine)
+
+@migration(2, "todo listing indexes")
+def _listing_indexes(engine):
+    create_index(engine, "ix_todos_owner_status_due_date", "todos", ["owner_id", "status", "due_date"])
+    create_index(engine, "ix_todos_owner_due_date", "todos", ["owner_id", "due_date"])
+
+@migration(3, "todo versions and revisions for ETags and the change feed")
+def _versions(engine):
+    add_column(engine, "users", "todos_version", "INTEGER NOT NULL DEFAULT 0")
+    add_column(engine, "users", "todos_updated_at", f"TIMESTAMP NOT NULL DEFAULT '{UNSET_TIMESTAMP}'")
+    add_column(engine, "todos", "version", "INTEGER NOT NULL DEFAULT 1")
+    add_column(engine, "todos", "updated_at", f"TIMESTAMP NOT NULL DEFAULT '{UNSET_TIMESTAMP}'")
+    add_column(engine, "todos", "revision", "INTEGER NOT NULL DEFAULT 0")
+    # ISO strings compare correctly against SQLite's text timestamps and cast on Postgres
+    params = {"now": datetime.utcnow().isoformat(" "), "cutoff": "1970-01-02"}
+    backfill(engine, "users", "todos_updated_at = :now", "todos_updated_at < :cutoff", params)
+    backfill(engine, "todos", "updated_at = :now", "updated_at < :cutoff", params)
+    create_index(engine, "ix_todos_owner_revision", "todos", ["owner_id", "revision"])
+
+# Tables added by later migrations, frozen as they were then like the baseline. Each
+# builder gets its own MetaData, with a stub users table for the foreign keys.
+
+def _users_stub() -> MetaData:
+    metadata = MetaData()
+    Table("users", metadata, Column("id", Integer, primary_key=True))
+    return metadata
+
+def _tombstones_v4() -> Table:
+    return Table(
+        "todo_tombstones", _users_stub(),
+        Column("todo_id", Integer, primary_key=True),
+        Column("owner_id", Integer, ForeignKey("users.id"), nullable=False),
+        Column("revision", Integer, nullable=False),
+        Column("deleted_at", DateTime, nullable=False),
+        Index("ix_todo_tombstones_owner_revision", "owner_id", "revision"),
+    )
+
+@migration(4, "todo tombstones")
+def _tombstones(engine):
+    _tombstones_v4().create(bind=engine, checkfirst=True)
+
+@migration(5, "full-text search index")
+def _search(engine):
+    with engine.begin() as conn:
+        create_search_index(conn)
+
+def _stats_v6() -> MetaData:
+    metadata = _users_stub()
+    Table(
+        "todo_stats", metadata,
+        Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+        Column("total", Integer, nullable=False),
+        Column("done", Integer, nullable=False),
+    )
+    Table(
+        "todo_due_counts", metadata,
+        Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+        Column("due_day", Date, primary_key=True),
+        Column("open_count", Integer, nullable=False),
+    )
+    return metadata
+
+@migration(6, "todo stats counters")
+def _stats(engine):
+    from stats import reconcile_stats
+    metadata = _stats_v6()
+    metadata.create_all(bind=engine, tables=[metadata.tables["todo_stats"], metadata.tables["todo_due_counts"]])
+    with engine.begin() as conn:
+        create_stats_triggers(conn)
+    # Seed the counters from existing todos, a batch of users per transaction
+    users = baseline.tables["users"]
+    last_id = 0
+    while True:
+        with Session(engine) as session, session.begin():
+            owner_ids = session.scalars(
+                select(users.c.id).where(users.c.id > last_id).order_by(users.c.id).limit(BACKFILL_BATCH_SIZE)
+            ).all()
+            if not owner_ids:
+                return
+            reconcile_stats(session, owner_ids)
+        last_id = owner_ids[-1]
+        time.sleep(BACKFILL_PAUSE_SECONDS)
+
+def _scheduler_state_v7() -> Table:
+    return Table(
+        "scheduler_state", MetaData(),
+        Column("job", String, primary_key=True),
+        Column("due_date", DateTime, nullable=False),
+        Column("todo_id", Integer, nullable=False),
+        Column("updated_at", DateTime, nullable=False),
+    )
+
+@migration(7, "due-date scheduler index and watermarks")
+def _scheduler(engine):
+    create_index(engine, "ix_todos_due_date", "todos", ["due_date"])
+    _scheduler_state_v7().create(bind=engine, checkfirst=True)
+
+def _tombstones_v8() -> Table:
+    return Table(
+        "todo_tombstones", _users_stub(),
+        Column("owner_id", Integer, ForeignKey("users.id"), primary_key=True),
+        Column("todo_id", Integer, primary_key=True),
+        Column("revision", Integer, nullable=False),
+        Column("deleted_at", DateTime, nullable=False),
+        Index("ix_todo_tombstones_owner_revision", "owner_id", "revision"),
+    )
+
+@migration(8, "todo tombstones keyed by owner and todo id")
+def _tombstone_key(engine):
+    if inspect(engine).get_pk_constraint("todo_tombstones")["constrained_columns"] == ["owner_id", "todo_id"]:
+        return
+    if engine.dialect.name == "postgresql":
+        name = inspect(engine).get_pk_constraint("todo_tombstones")["name"]
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE todo_tombstones DROP CONSTRAINT {name}, ADD PRIMARY KEY (owner_id, todo_id)"))
+        return
+    # SQLite can't change a primary key in place: rebuild the (small) table
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE todo_tombstones RENAME TO todo_tombstones_old"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_todo_tombstones_owner_revision"))
+        _tombstones_v8().create(conn)
+        conn.execute(text(
+            "INSERT INTO todo_tombstones (owner_id, todo_id, revision, deleted_at) "
+            "SELECT owner_id, todo_id, revision, deleted_at FROM todo_tombstones_old"
+        ))
+        conn.execute(text("DROP TABLE todo_tombstones_old"))
+
+def _user_directory_v9() -> Table:
+    return Table(
+        "user_directory", MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("username", String, nullable=False, unique=True, index=True),
+        Column("shard", Integer, nullable=False),
+    )
+
+@migration(9, "user directory for sharding")
+def _user_directory(engine):
+    if shard_index(engine) not in (0, None):
+        return  # the directory lives on shard 0 only
+    _user_directory_v9().create(bind=engine, checkfirst=True)
+    # Existing users stay where they are
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO user_directory (id, username, shard) SELECT id, username, 0 FROM users "
+            "WHERE NOT EXISTS (SELECT 1 FROM user_directory WHERE user_directory.id = users.id)"
+        ))
+
+def _todos_v10() -> Table:
+    # The todos table as of migration 10, frozen like the baseline
+    return Table(
+        "todos", _users_stub(),
+        Column("id", Integer, primary_key=True, index=True),
+        Column("name", String, index=True),
+        Column("description", Text),
+        Column("due_date", DateTime),
+        Column("status", Boolean),
+        Column("owner_id", Integer, ForeignKey("users.id")),
+        Column("version", Integer, nullable=False, server_default="1"),
+        Column("updated_at", DateTime, nullable=False, server_default=func.current_timestamp()),
+        Column("revision", Integer, nullable=False, server_default="0"),
+        Index("ix_todos_owner_status_due_date", "owner_id", "status", "due_date"),
+        Index("ix_todos_owner_due_date", "owner_id", "due_date"),
+        Index("ix_todos_owner_revision", "owner_id", "revision"),
+        Index("ix_todos_due_date", "due_date"),
+        sqlite_autoincrement=True,
+    )
+
+@migration(10, "todo ids are never reused")
+def _todo_autoincrement(engine):
+    if engine.dialect.name != "sqlite":
+        return  # sequences don't hand out an id twice
+    with engine.connect() as conn:
+        table_sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'todos'")).scalar()
+    if "AUTOINCREMENT" in table_sql.upper():
+        return
+    # Rebuild the table with AUTOINCREMENT. The new table is created without DDL events
+    # and the triggers are added after the copy, so the search index and the stats
+    # counters (whose rows already match) aren't written a second time.
+    todos = _todos_v10()
+    columns = ", ".join(column.name for column in todos.columns)
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE todos RENAME TO todos_old"))
+        for trigger in ("todos_fts_ai", "todos_fts_ad", "todos_fts_au", "todo_stats_ai", "todo_stats_ad", "todo_stats_au"):
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        indexes = conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'todos_old' AND sql IS NOT NULL"
+        )).scalars().all()
+        for index in indexes:
+            conn.execute(text(f"DROP INDEX {index}"))
+        conn.execute(CreateTable(todos))
+        for index in todos.indexes:
+            conn.execute(CreateIndex(index))
+        conn.execute(text(f"INSERT INTO todos ({columns}) SELECT {columns} FROM todos_old"))
+        conn.execute(text("DROP TABLE todos_old"))
+        create_search_index(conn)
+        create_stats_triggers(conn)
+        # Ids of todos already deleted above the current maximum aren't handed out either
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) SELECT 'todos', 0 "
+                          "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'todos')"))
+        conn.execute(text("UPDATE sqlite_sequence SET seq = max(seq, (SELECT coalesce(max(todo_id), 0) FROM todo_tombstones)) "
+                          "WHERE name = 'todos'"))
+
+def _scheduler_notifications_v11() -> Table:
+    return Table(
+        "scheduler_notifications", MetaData(),
+        Column("job", String, primary_key=True),
+        Column("todo_id", Integer, primary_key=True),
+        Column("due_date", DateTime, nullable=False),
+        Index("ix_scheduler_notifications_job_due_date", "job", "due_date"),
+    )
+
+@migration(11, "due-date scheduler notification markers")
+def _scheduler_notifications(engine):
+    _scheduler_notifications_v11().create(bind=engine, checkfirst=True)
+
+@migration(12, "drop the unused scheduler watermark todo id")
+def _scheduler_state_todo_id(engine):
+    drop_column(engine, "scheduler_state", "todo_id")
+
+
+# Runner
+
+def applied_versions(engine) -> dict:
+    schema_migrations.create(bind=engine, checkfirst=True)
+    with engine.connect() as conn:
+        return {row.version: row for row in conn.execute(select(schema_migrations))}
+
+def pending(engine) -> List[Migration]:
+    applied = applied_versions(engine)
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m.version) if m.version not in applied]
+
+def upgrade(engine=default_engine, target: Optional[int] = None) -> List[Migration]:
+    """Apply pending migrations up to `target` (default: all). Callers serialise
+    concurrent runs with database.db_init_lock()."""
+    done = []
+    for m in pending(engine):
+        if target is not None and m.version > target:
+            break
+        logger.info("Applying migration %04d: %s", m.version, m.name)
+        started = time.perf_counter()
+        m.upgrade(engine)
+        with engine.begin() as conn:
+            conn.execute(schema_migrations.insert().values(version=m.version, name=m.name, applied_at=datetime.utcnow()))
+        logger.info("Applied migration %04d in %.2fs", m.version, time.perf_counter() - started)
+        done.append(m)
+    return done
+
+def index_report(engine=default_engine) -> dict:
+    """Indexes declared on the models but missing from the database, and vice versa."""
+    inspector = inspect(engine)
+    report = {"missing": [], "unexpected": []}
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        declared = {index.name for index in table.indexes}
+        live = {index["name"] for index in inspector.get_indexes(table.name)}
+        report["missing"] += [f"{table.name}.{name}" for name in sorted(declared - live)]
+        report["unexpected"] += [f"{table.name}.{name}" for name in sorted(live - declared)]
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the todo database schema")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="list applied and pending migrations")
+    upgrade_parser = commands.add_parser("upgrade", help="apply pending migrations")
+    upgrade_parser.add_argument("--to", type=int, dest="target", help="stop after this version")
+    commands.add_parser("indexes", help="compare live indexes with the models")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    missing = False
+    for shard in shards:
+        # One report per shard; passwords in the URL stay out of the output
+        print(f"shard {shard.index}  {make_url(shard.url).render_as_string(hide_password=True)}")
+        if args.command == "status":
+            applied = applied_versions(shard.engine)
+            for m in sorted(MIGRATIONS, key=lambda m: m.version):
+                row = applied.get(m.version)
+                state = f"applied {row.applied_at:%Y-%m-%d %H:%M:%S}" if row else "pending"
+                print(f"  {m.version:04d}  {state:<28} {m.name}")
+        elif args.command == "upgrade":
+            with db_init_lock():
+                done = upgrade(shard.engine, args.target)
+            print(f"  Applied {len(done)} migration(s)" if done else "  Database is up to date")
+        elif args.command == "indexes":
+            report = index_report(shard.engine)
+            for name in report["missing"]:
+                print(f"  missing     {name}")
+            for name in report["unexpected"]:
+                print(f"  unexpected  {name}")
+            missing = missing or bool(report["missing"])
+    if missing:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# passwords.py
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+# bcrypt cost factor. Hashes made with a different cost are transparently
+# re-hashed on the next successful login (see verify_and_update_password).
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# Size of the dedicated process pool for password work; 0 runs it on a thread instead
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hash/verify jobs allowed in flight (running + queued) before requests get a 503
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", str(max(PASSWORD_WORKERS, 1) * 8)))
+PASSWORD_RETRY_AFTER_SECONDS = 1
+
+
+@lru_cache(maxsize=None)
+def get_pwd_context(rounds: int = None) -> CryptContext:
+    rounds = BCRYPT_ROUNDS if rounds is None else rounds
+    # min/max rounds make needs_update() flag hashes made with any other cost
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+
+# These run inside the worker processes, so they take the cost explicitly
+# rather than relying on the child seeing the same module state.
+def _hash(password: str, rounds: int) -> str:
+    return get_pwd_context(rounds).hash(password)
+
+def _verify_and_update(password: str, hashed_password: str, rounds: int):
+    return get_pwd_context(rounds).verify_and_update(password, hashed_password)
+
+
+class PasswordHasherPool:
+    """Runs bcrypt on a size-limited process pool so it neither holds the GIL
+    nor occupies the request threadpool, and sheds load once the queue is full."""
+
+    def __init__(self, workers: int = PASSWORD_WORKERS, queue_limit: int = PASSWORD_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.in_flight = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None and self.workers > 0:
+            # spawn: forking a process that already runs threads (event loop, threadpool) is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.in_flight >= self.queue_limit:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Server is busy, please retry",
+                    headers={"Retry-After": str(PASSWORD_RETRY_AFTER_SECONDS)},
+                )
+            self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+hasher_pool = PasswordHasherPool()
+
+
+async def hash_password_async(password: str) -> str:
+    return await hasher_pool.run(_hash, password, BCRYPT_ROUNDS)
+
+async def verify_and_update_password(password: str, hashed_password: str):
+    """Return (valid, new_hash); new_hash is set when the stored hash uses an outdated cost."""
+    return await hasher_pool.run(_verify_and_update, password, hashed_password, BCRYPT_ROUNDS)
@@ -0,0 +1,235 @@
+# ratelimit.py
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from metrics import Counter, registry
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# "memory" keeps buckets per process; "sqlite" shares them between workers on one host
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "./ratelimit.db")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# Global admission control: beyond this many in-flight requests new ones get a 503
+# straight away instead of queueing behind the pool/threads. Long-lived streams don't count.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "256"))
+MAX_CONCURRENT_WRITES = int(os.getenv("MAX_CONCURRENT_WRITES", "64"))
+UNLIMITED_PATHS = ("/todos/stream", "/metrics")
+
+rate_limited = registry.register(Counter(
+    "todo_rate_limited_total", "Requests rejected with 429 by the rate limiter", ("group",)))
+load_shed = registry.register(Counter(
+    "todo_load_shed_total", "Requests rejected with 503 by a concurrency cap", ("limit",)))
+
+
+@dataclass(frozen=True)
+class Budget:
+    per_minute: float
+    burst: int
+
+    @property
+    def rate(self) -> float:
+        return self.per_minute / 60.0
+
+def _budget(name: str, per_minute: int, burst: int) -> Budget:
+    return Budget(
+        float(os.getenv(f"RATE_LIMIT_{name}_PER_MINUTE", str(per_minute))),
+        int(os.getenv(f"RATE_LIMIT_{name}_BURST", str(burst))),
+    )
+
+# Route groups and their budgets
+BUDGETS: Dict[str, Budget] = {
+    "login_ip": _budget("LOGIN_IP", 30, 10),      # /token, /token/refresh, /register per client IP
+    "login_user": _budget("LOGIN_USER", 10, 5),   # /token per username, against distributed guessing
+    "writes": _budget("WRITES", 600, 120),        # todo mutations per user
+}
+
+
+def take(tokens: float, updated: float, now: float, budget: Budget, cost: float) -> Tuple[float, float]:
+    """Token bucket step: (tokens left, seconds to wait; 0 if allowed)."""
+    tokens = min(budget.burst, tokens + (now - updated) * budget.rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / budget.rate if budget.rate > 0 else math.inf
+
+
+class RateLimitBackend:
+    """Bucket storage. acquire() must be atomic per key across everything sharing the backend."""
+
+    async def acquire(self, key: str, budget: Budget, cost: float = 1) -> float:
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+
+class InMemoryBackend(RateLimitBackend):
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated); LRU, an evicted key starts full
+        self._lock = threading.Lock()
+
+    async def acquire(self, key, budget, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (budget.burst, now))
+            tokens, wait = take(tokens, updated, now, budget, cost)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBackend(RateLimitBackend):
+    """Buckets in a SQLite file shared by all workers on the host; swap in Redis
+    (same acquire() contract) when workers span machines."""
+
+    def __init__(self, path: str = RATE_LIMIT_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # losing a few buckets on a crash is fine
+            self._local.conn = conn
+        return conn
+
+    def _acquire(self, key, budget, cost):
+        conn = self._connect()
+        now = time.time()  # wall clock: shared between processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (budget.burst, now)
+            tokens, wait = take(tokens, updated, now, budget, cost)
+            conn.execute(
+                "INSERT INTO rate_limits (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    async def acquire(self, key, budget, cost=1):
+        return await asyncio.to_thread(self._acquire, key, budget, cost)
+
+    def reset(self):
+        self._connect().execute("DELETE FROM rate_limits")
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend, budgets: Dict[str, Budget] = BUDGETS):
+        self.backend = backend
+        self.budgets = budgets
+
+    async def hit(self, group: str, key: str, cost: float = 1):
+        """Spend `cost` from the caller's bucket or raise 429 with Retry-After."""
+        if not RATE_LIMIT_ENABLED:
+            return
+        wait = await self.backend.acquire(f"{group}:{key}", self.budgets[group], cost)
+        if wait > 0:
+            rate_limited.inc(group)
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+
+    def reset(self):
+        self.backend.reset()
+
+
+def create_backend(name: str = RATE_LIMIT_BACKEND) -> RateLimitBackend:
+    if name == "sqlite":
+        return SQLiteBackend()
+    return InMemoryBackend()
+
+
+rate_limiter = RateLimiter(create_backend())
+
+
+def client_ip(request: Request) -> str:
+    # uvicorn resolves X-Forwarded-For from trusted proxies into request.client (serve.py)
+    return request.client.host if request.client else "unknown"
+
+async def limit_login_by_ip(request: Request):
+    await rate_limiter.hit("login_ip", client_ip(request))
+
+
+class ConcurrencyLimiter:
+    """Non-blocking counting semaphore: callers over the limit are rejected, not queued."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @contextmanager
+    def slot(self):
+        if not self.try_acquire():
+            load_shed.inc(self.name)
+            raise HTTPException(status_code=503, detail="Server busy, retry shortly", headers={"Retry-After": "1"})
+        try:
+            yield
+        finally:
+            self.release()
+
+
+request_slots = ConcurrencyLimiter("requests", MAX_CONCURRENT_REQUESTS)
+write_slots = ConcurrencyLimiter("writes", MAX_CONCURRENT_WRITES)
+
+
+class AdmissionControlMiddleware:
+    """Pure ASGI: rejects requests beyond MAX_CONCURRENT_REQUESTS with an immediate 503."""
+
+    def __init__(self, app, limiter: ConcurrencyLimiter = request_slots):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(UNLIMITED_PATHS):
+            return await self.app(scope, receive, send)
+        if not self.limiter.try_acquire():
+            load_shed.inc(self.limiter.name)
+            response = JSONResponse({"detail": "Server busy, retry shortly"}, status_code=503, headers={"Retry-After": "1"})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release()
@@ -0,0 +1,270 @@
+# scheduler.py
+"""In-process background jobs, started from the app lifespan (main.py).
+
+Due-date jobs rescan their window, todos due from the window start up to now + lead,
+by the ix_todos_due_date index in (due_date, id) keyset order, and hand the open todos
+not yet notified for their current due date to the notifier a batch at a time, then
+record them in scheduler_notifications. So a todo created with, or moved to, an
+earlier due date than ones already notified is still picked up, and a rescheduled
+todo is notified again. Delivery is at-least-once: a batch whose notification fails
+is retried on the next tick.
+
+The window starts where the job first ran (scheduler_state) and follows now at most
+SCHEDULER_CATCH_UP_HOURS behind, so downtime shorter than that is caught up on and
+the markers of todos due before the window are pruned.
+
+The price of the rescan: once a job has run for SCHEDULER_CATCH_UP_HOURS, every tick
+reads all todos due in the last SCHEDULER_CATCH_UP_HOURS plus the lead, and probes
+the markers' primary key for each open one. That is an index range scan bounded by
+how many todos fall due in that span, not by the table size, and it is what a
+(due_date, id) watermark would miss: todos added or moved behind it. Deployments
+with many todos due per day and little downtime to cover can lower
+SCHEDULER_CATCH_UP_HOURS to shrink the scan.
+
+Only one process per host runs the jobs (a non-blocking file lock; another worker
+takes over if the holder exits), at most SCHEDULER_CONCURRENCY jobs at a time, and
+a tick is skipped while the request admission cap is half used.
+"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib.request
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import and_, delete, exists, false, func, insert, or_, select
+from sqlalchemy.orm import Session
+
+from database import AsyncSessionLocal, SchedulerNotification, SchedulerState, Todo, fcntl, shards
+from metrics import Counter, Histogram, registry
+from ratelimit import request_slots
+from stats import STATS_RECONCILE_SECONDS, reconcile_all
+from writer import run_write
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "30"))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "1"))
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "200"))
+SCHEDULER_CATCH_UP_HOURS = float(os.getenv("SCHEDULER_CATCH_UP_HOURS", "24"))
+SCHEDULER_LOCK = os.getenv("SCHEDULER_LOCK", os.path.join(tempfile.gettempdir(), "todo-scheduler.lock"))
+# Reminders go out this long before a todo is due
+REMINDER_LEAD_MINUTES = float(os.getenv("REMINDER_LEAD_MINUTES", "60"))
+# "log", or "webhook" to POST each batch as JSON to REMINDER_WEBHOOK_URL
+REMINDER_NOTIFIER = os.getenv("REMINDER_NOTIFIER", "log")
+REMINDER_WEBHOOK_URL = os.getenv("REMINDER_WEBHOOK_URL", "")
+REMINDER_WEBHOOK_TIMEOUT = float(os.getenv("REMINDER_WEBHOOK_TIMEOUT", "5"))
+
+logger = logging.getLogger(__name__)
+
+job_runs = registry.register(Counter(
+    "todo_scheduler_runs_total", "Scheduler job runs", ("job", "outcome")))
+job_time = registry.register(Histogram(
+    "todo_scheduler_job_duration_seconds", "Duration of scheduler job runs", ("job",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)))
+notifications = registry.register(Counter(
+    "todo_scheduler_notifications_total", "Todos handed to the notifier", ("kind",)))
+
+
+# Notifiers
+
+class Notifier:
+    async def notify(self, kind: str, todos: List[dict]):
+        """Deliver one batch; raising leaves the batch to be retried."""
+        raise NotImplementedError
+
+class LogNotifier(Notifier):
+    async def notify(self, kind, todos):
+        for todo in todos:
+            logger.info("%s: todo %s of user %s (%r) due %s", kind, todo["id"], todo["owner_id"], todo["name"], todo["due_date"])
+
+class WebhookNotifier(Notifier):
+    def __init__(self, url: str, timeout: float = REMINDER_WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, body: bytes):
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    async def notify(self, kind, todos):
+        body = json.dumps({"type": kind, "todos": todos}, default=str).encode()
+        await asyncio.to_thread(self._post, body)
+
+def create_notifier(name: str = REMINDER_NOTIFIER) -> Notifier:
+    if name == "webhook":
+        return WebhookNotifier(REMINDER_WEBHOOK_URL)
+    return LogNotifier()
+
+
+# Due-date jobs
+
+@dataclass
+class DueDateJob:
+    name: str  # also the notification kind and the scheduler_state key
+    lead: timedelta  # notify todos due up to `lead` from now
+
+    def horizon(self, now: datetime) -> datetime:
+        return now + self.lead
+
+def window_start(state: Optional[SchedulerState], now: datetime) -> datetime:
+    # The first run starts from now rather than replaying every todo that was ever due
+    if state is None:
+        return now
+    return max(state.due_date, now - timedelta(hours=SCHEDULER_CATCH_UP_HOURS))
+
+def save_window_start(session: Session, job: str, start: datetime):
+    session.merge(SchedulerState(job=job, due_date=start))
+    session.execute(delete(SchedulerNotification).where(
+        SchedulerNotification.job == job, SchedulerNotification.due_date < start))
+
+def mark_notified(session: Session, job: str, rows):
+    ids = [row.id for row in rows]
+    session.execute(delete(SchedulerNotification).where(
+        SchedulerNotification.job == job, SchedulerNotification.todo_id.in_(ids)))
+    session.execute(insert(SchedulerNotification), [
+        {"job": job, "todo_id": row.id, "due_date": row.due_date} for row in rows
+    ])
+
+async def run_due_date_job(job: DueDateJob, notifier: Notifier, now: Optional[datetime] = None,
+                           batch_size: int = SCHEDULER_BATCH_SIZE, sessions=None) -> int:
+    """Notify open todos due in [window start, horizon] on one shard (default: shard 0)
+    that weren't notified for their current due date yet, a batch at a time. Returns the count."""
+    now = now or datetime.utcnow()
+    horizon = job.horizon(now)
+    sent = 0
+    async with (sessions or AsyncSessionLocal)() as db:
+        state = await db.get(SchedulerState, job.name)
+        start = window_start(state, now)
+        if state is None or state.due_date != start:
+            await run_write(db, lambda session: save_window_start(session, job.name, start))
+        notified = exists().where(
+            SchedulerNotification.job == job.name,
+            SchedulerNotification.todo_id == Todo.id,
+            SchedulerNotification.due_date == Todo.due_date,
+        )
+        due_date, todo_id = start, 0
+        while True:
+            # Done todos are skipped by the filter
+            rows = (await db.execute(
+                select(Todo.id, Todo.owner_id, Todo.name, Todo.due_date)
+                .where(
+                    or_(Todo.due_date > due_date, and_(Todo.due_date == due_date, Todo.id > todo_id)),
+                    Todo.due_date <= horizon,
+                    func.coalesce(Todo.status, false()) == false(),
+                    ~notified,
+                )
+                .order_by(Todo.due_date, Todo.id)
+                .limit(batch_size)
+            )).all()
+            await db.rollback()  # no read snapshot held while notifying
+            if rows:
+                await notifier.notify(job.name, [row._asdict() for row in rows])
+                notifications.inc(job.name, amount=len(rows))
+                sent += len(rows)
+                await run_write(db, lambda session, rows=rows: mark_notified(session, job.name, rows))
+                due_date, todo_id = rows[-1].due_date, rows[-1].id
+            if len(rows) < batch_size:
+                return sent
+            await asyncio.sleep(0)  # let request handlers in between batches
+
+DUE_DATE_JOBS = [
+    DueDateJob("reminder", timedelta(minutes=REMINDER_LEAD_MINUTES)),
+    DueDateJob("overdue", timedelta(0)),
+]
+
+
+# Scheduler
+
+@dataclass
+class Job:
+    name: str
+    interval: float
+    run: Callable[[], Awaitable]
+    next_run: float = 0.0
+
+class Scheduler:
+    def __init__(self, tick: float = SCHEDULER_TICK_SECONDS, concurrency: int = SCHEDULER_CONCURRENCY,
+                 lock_path: str = SCHEDULER_LOCK):
+        self.tick = tick
+        self.jobs: List[Job] = []
+        self.lock_path = lock_path
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock_file = None
+        self._task = None
+
+    def every(self, interval: float, name: str, run: Callable[[], Awaitable], first_run: float = 0.0):
+        self.jobs.append(Job(name, interval, run, time.monotonic() + first_run))
+
+    def is_leader(self) -> bool:
+        """Hold the host-wide lock so only one worker runs the jobs."""
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        self._lock_file = lock_file
+        return True
+
+    def busy(self) -> bool:
+        return request_slots.in_flight >= request_slots.limit // 2
+
+    async def _run_job(self, job: Job):
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                await job.run()
+                job_runs.inc(job.name, "ok")
+            except Exception:
+                job_runs.inc(job.name, "error")
+                logger.exception("Scheduler job %s failed", job.name)
+            finally:
+                job_time.observe(job.name, value=time.perf_counter() - started)
+
+    async def run_pending(self):
+        now = time.monotonic()
+        due = [job for job in self.jobs if job.next_run <= now]
+        for job in due:
+            job.next_run = now + job.interval
+        await asyncio.gather(*(self._run_job(job) for job in due))
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            if self.busy() or not self.is_leader():
+                continue
+            await self.run_pending()
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock_file is not None:
+            self._lock_file.close()  # releases the flock
+            self._lock_file = None
+
+
+def create_scheduler(notifier: Optional[Notifier] = None) -> Scheduler:
+    scheduler = Scheduler()
+    notifier = notifier or create_notifier()
+    for job in DUE_DATE_JOBS:
+        for shard in shards:  # each shard keeps its own window start in its scheduler_state
+            scheduler.every(SCHEDULER_TICK_SECONDS, f"{job.name}:{shard.index}",
+                            lambda job=job, shard=shard: run_due_date_job(job, notifier, sessions=shard.sessions))
+    scheduler.every(STATS_RECONCILE_SECONDS, "stats_reconcile", reconcile_all, first_run=STATS_RECONCILE_SECONDS)
+    return scheduler
@@ -0,0 +1,86 @@
+# serve.py
+"""Production launcher: prepares the database once, then runs N uvicorn workers.
+
+    python serve.py --workers 4 --port 8000
+    WEB_CONCURRENCY=8 THREADPOOL_SIZE=20 python serve.py
+
+The parent process runs init_db() before any worker starts, then uvicorn's supervisor
+forks the workers, which share nothing but the database. Signals to the parent:
+SIGHUP restarts the workers one by one (rolling reload), SIGTTIN/SIGTTOU add or
+remove a worker, SIGINT/SIGTERM drain in-flight requests for --graceful-timeout
+seconds before exiting. uvloop and httptools are used when installed
+(pip install uvloop httptools).
+"""
+import argparse
+import importlib.util
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def pick(module: str, preferred: str, fallback: str) -> str:
+    return preferred if importlib.util.find_spec(module) is not None else fallback
+
+
+def worker_defaults(workers: int):
+    """Split per-host resources between workers unless configured explicitly."""
+    cpus = os.cpu_count() or 1
+    os.environ.setdefault("PASSWORD_WORKERS", str(max(1, min(4, cpus // workers))))
+    if workers > 1:
+        # Live-update events and rate-limit buckets must be shared by every worker
+        os.environ.setdefault("EVENTS_BACKEND", "sqlite")
+        os.environ.setdefault("RATE_LIMIT_BACKEND", "sqlite")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the todo API with multiple worker processes")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--loop", choices=["auto", "uvloop", "asyncio"], default="auto")
+    parser.add_argument("--http", choices=["auto", "httptools", "h11"], default="auto")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+                        help="seconds to let in-flight requests finish on shutdown/restart")
+    parser.add_argument("--reload", action="store_true", help="development mode: one worker, restart on code changes")
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+    workers = 1 if args.reload else max(1, args.workers)
+    if args.reload:
+        os.environ.setdefault("STATIC_WATCH", "1")  # pick up edits under static/ too
+    worker_defaults(workers)
+    loop = pick("uvloop", "uvloop", "asyncio") if args.loop == "auto" else args.loop
+    http = pick("httptools", "httptools", "h11") if args.http == "auto" else args.http
+
+    # Imported here so worker_defaults() is applied before any settings are read
+    from database import db_init_lock, init_db, shards
+    with db_init_lock():
+        init_db()  # applies pending migrations (migrations.py) on every shard
+    for shard in shards:
+        shard.engine.dispose()
+    # Workers inherit this and skip their own init in the lifespan
+    os.environ["TODO_DB_INITIALIZED"] = "1"
+
+    import uvicorn
+    logger.info("Starting %d worker(s) on %s:%d (loop=%s, http=%s)", workers, args.host, args.port, loop, http)
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        reload=args.reload,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level,
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# shards.py
+"""User directory and offline rebalancing across database shards.
+
+Each user's row, todos, tombstones and stats live together on one shard
+(database.shards, configured by DATABASE_URL + EXTRA_SHARD_URLS). New users are
+placed by a stable hash of their id; the user_directory table on shard 0 records
+where every user actually is, so users can be moved without rehashing everyone.
+
+    python shards.py status                       # users per shard
+    python shards.py move USERNAME SHARD          # move one user's rows
+    python shards.py rebalance [--dry-run]        # move users to their hash placement
+
+Moves are offline: stop the app (or at least keep the user logged out) while they run,
+since workers cache which shard a token's user is on. Moved todos get new ids on the
+target shard; the old ids are recorded as tombstones at a new revision, so clients
+following /todos/changes see the old todos deleted and the new ones created.
+A move interrupted part-way can simply be run again.
+"""
+import argparse
+import logging
+import sys
+from typing import List, Optional
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import Todo, TodoDueCount, TodoStats, TodoTombstone, User, UserDirectory, placement_shard, shards
+from stats import reconcile_stats
+
+logger = logging.getLogger(__name__)
+
+OWNED_TABLES = (TodoDueCount, TodoStats, TodoTombstone, Todo)  # deleted in this order, then the user
+
+
+async def lookup_user(db: AsyncSession, username: str) -> Optional[UserDirectory]:
+    """Directory entry (global id and shard) of a username; `db` is a shard 0 session."""
+    return await db.scalar(select(UserDirectory).where(UserDirectory.username == username))
+
+
+# Offline tools (sync engines)
+
+def _purge_user(session: Session, user_id: int):
+    for model in OWNED_TABLES:
+        session.execute(delete(model).where(model.owner_id == user_id))
+    session.execute(delete(User).where(User.id == user_id))
+
+def _copy_user(source: Session, target: Session, user_id: int) -> int:
+    """Copy a user's rows to `target` with fresh todo ids. Returns the number of todos."""
+    user = source.get(User, user_id)
+    todos = source.execute(select(Todo.__table__).where(Todo.owner_id == user_id).order_by(Todo.id)).mappings().all()
+    tombstones = source.execute(
+        select(TodoTombstone.__table__).where(TodoTombstone.owner_id == user_id)
+    ).mappings().all()
+
+    # Fresh ids above anything on the target (live or deleted) and above this user's old
+    # ids, so the tombstones of the old ids can't be mistaken for the new todos
+    revision = user.todos_version + 1
+    next_id = 1 + max(
+        target.scalar(select(func.max(Todo.id))) or 0,
+        target.scalar(select(func.max(TodoTombstone.todo_id))) or 0,
+        max((todo["id"] for todo in todos), default=0),
+        max((tombstone["todo_id"] for tombstone in tombstones), default=0),
+    )
+    target.execute(insert(User).values(
+        id=user.id, username=user.username, password_hash=user.password_hash,
+        todos_version=revision, todos_updated_at=user.todos_updated_at,
+    ))
+    if todos:
+        target.execute(insert(Todo), [
+            {**todo, "id": next_id + n, "revision": revision} for n, todo in enumerate(todos)
+        ])
+    # Old tombstones, then one per moved todo's old id (replacing any for a reused id)
+    moved_ids = {todo["id"] for todo in todos}
+    tombstone_rows = [dict(tombstone) for tombstone in tombstones if tombstone["todo_id"] not in moved_ids] + [
+        {"owner_id": user_id, "todo_id": todo["id"], "revision": revision, "deleted_at": user.todos_updated_at}
+        for todo in todos
+    ]
+    if tombstone_rows:
+        target.execute(insert(TodoTombstone), tombstone_rows)
+    # The triggers counted the inserts; reconcile anyway in case the source had drifted
+    reconcile_stats(target, [user_id])
+    return len(todos)
+
+def move_user(username: str, target_shard: int) -> int:
+    """Move a user and everything they own to `target_shard`. Returns the todos moved."""
+    directory = shards[0].engine
+    with Session(directory) as session:
+        entry = session.scalar(select(UserDirectory).where(UserDirectory.username == username))
+        if entry is None:
+            raise LookupError(f"No user named {username!r}")
+        user_id, source_shard = entry.id, entry.shard
+    if not 0 <= target_shard < len(shards):
+        raise ValueError(f"No shard {target_shard} (there are {len(shards)})")
+
+    moved = 0
+    if source_shard != target_shard:
+        with Session(shards[source_shard].engine) as source, Session(shards[target_shard].engine) as target:
+            with target.begin():
+                _purge_user(target, user_id)  # leftovers of an interrupted move
+                moved = _copy_user(source, target, user_id)
+        # The directory update is the commit point of the move
+        with Session(directory) as session, session.begin():
+            session.execute(update(UserDirectory).where(UserDirectory.id == user_id).values(shard=target_shard))
+        logger.info("Moved user %s (%d todos) from shard %d to %d", username, moved, source_shard, target_shard)
+    # Remove the rows from every shard but the user's own (also cleans up after an
+    # earlier move that stopped after the directory update)
+    for shard in shards:
+        if shard.index != target_shard:
+            with Session(shard.engine) as session, session.begin():
+                _purge_user(session, user_id)
+    return moved
+
+def users_per_shard() -> List[int]:
+    counts = [0] * len(shards)
+    with Session(shards[0].engine) as session:
+        for shard, count in session.execute(select(UserDirectory.shard, func.count()).group_by(UserDirectory.shard)):
+            if shard < len(counts):
+                counts[shard] = count
+    return counts
+
+def misplaced_users() -> List[tuple]:
+    """(username, current shard, placement shard) of users not on their hash placement."""
+    with Session(shards[0].engine) as session:
+        entries = session.execute(select(UserDirectory.username, UserDirectory.id, UserDirectory.shard)).all()
+    return [(username, shard, placement_shard(user_id)) for username, user_id, shard in entries
+            if shard != placement_shard(user_id)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and rebalance user shards (run with the app stopped)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="users per shard")
+    move_parser = commands.add_parser("move", help="move one user to a shard")
+    move_parser.add_argument("username")
+    move_parser.add_argument("shard", type=int)
+    rebalance_parser = commands.add_parser("rebalance", help="move users to their hash placement")
+    rebalance_parser.add_argument("--dry-run", action="store_true")
+    rebalance_parser.add_argument("--limit", type=int, help="move at most this many users")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.command == "status":
+        for shard, count in zip(shards, users_per_shard()):
+            print(f"{shard.index:>3}  {count:>8} users  {shard.url}")
+    elif args.command == "move":
+        try:
+            moved = move_user(args.username, args.shard)
+        except (LookupError, ValueError) as exc:
+            print(exc, file=sys.stderr)
+            return 1
+        print(f"Moved {moved} todo(s)")
+    elif args.command == "rebalance":
+        plan = misplaced_users()[:args.limit]
+        for username, current, placement in plan:
+            print(f"{username}: shard {current} -> {placement}")
+            if not args.dry_run:
+                move_user(username, placement)
+        print(f"{len(plan)} user(s) {'to move' if args.dry_run else 'moved'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# stats.py
+import logging
+import os
+import time
+from datetime import date, timedelta
+from typing import List
+
+from pydantic import BaseModel
+from sqlalchemy import case, delete, func, insert, select, true
+from sqlalchemy.orm import Session
+
+from database import Todo, TodoDueCount, TodoStats, User, shards
+from metrics import Counter, Histogram, registry
+from writer import run_write
+
+# The triggers keep the counters exact; reconciling only repairs drift from writes that
+# bypassed them (manual SQL, restores). Each batch of users is one short write job;
+# scheduler.py runs it every STATS_RECONCILE_SECONDS.
+STATS_RECONCILE_SECONDS = float(os.getenv("STATS_RECONCILE_SECONDS", "3600"))
+STATS_RECONCILE_BATCH = int(os.getenv("STATS_RECONCILE_BATCH", "500"))
+
+logger = logging.getLogger(__name__)
+
+reconcile_runs = registry.register(Counter(
+    "todo_stats_reconcile_total", "Todo statistics reconcile runs"))
+reconcile_time = registry.register(Histogram(
+    "todo_stats_reconcile_duration_seconds", "Duration of a full todo statistics reconcile", (),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)))
+
+
+class TodoStatsResponse(BaseModel):
+    total: int
+    done: int
+    open: int
+    overdue: int  # open, due on a day before today (UTC)
+    due_today: int
+    due_this_week: int  # open, due today or in the next 6 days
+    as_of: date
+
+
+async def read_stats(db, owner_id: int, today: date) -> TodoStatsResponse:
+    counts = (await db.execute(
+        select(TodoStats.total, TodoStats.done).where(TodoStats.owner_id == owner_id)
+    )).first()
+    total, done = counts if counts else (0, 0)
+    week_end = today + timedelta(days=7)
+
+    def open_between(condition):
+        return func.coalesce(func.sum(case((condition, TodoDueCount.open_count), else_=0)), 0)
+
+    # Range over this user's due-day rows up to a week ahead: a handful of rows, not todos
+    overdue, due_today, due_this_week = (await db.execute(
+        select(
+            open_between(TodoDueCount.due_day < today),
+            open_between(TodoDueCount.due_day == today),
+            open_between(TodoDueCount.due_day >= today),
+        ).where(TodoDueCount.owner_id == owner_id, TodoDueCount.due_day < week_end, TodoDueCount.open_count > 0)
+    )).one()
+    return TodoStatsResponse(
+        total=total, done=done, open=total - done, overdue=overdue,
+        due_today=due_today, due_this_week=due_this_week, as_of=today,
+    )
+
+
+def reconcile_stats(session: Session, owner_ids: List[int]):
+    """Recompute the counters of `owner_ids` from their todos."""
+    session.execute(delete(TodoStats).where(TodoStats.owner_id.in_(owner_ids)))
+    session.execute(delete(TodoDueCount).where(TodoDueCount.owner_id.in_(owner_ids)))
+    session.execute(insert(TodoStats).from_select(
+        ["owner_id", "total", "done"],
+        select(Todo.owner_id, func.count(), func.sum(case((Todo.status == true(), 1), else_=0)))
+        .where(Todo.owner_id.in_(owner_ids))
+        .group_by(Todo.owner_id),
+    ))
+    due_day = func.date(Todo.due_date)
+    session.execute(insert(TodoDueCount).from_select(
+        ["owner_id", "due_day", "open_count"],
+        select(Todo.owner_id, due_day, func.count())
+        .where(Todo.owner_id.in_(owner_ids), Todo.due_date.isnot(None), func.coalesce(Todo.status, False) != true())
+        .group_by(Todo.owner_id, due_day),
+    ))
+
+
+async def reconcile_shard(sessions, batch_size: int = STATS_RECONCILE_BATCH) -> int:
+    users = 0
+    async with sessions() as db:
+        last_id = 0
+        while True:
+            owner_ids = (await db.scalars(
+                select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+            )).all()
+            await db.rollback()  # don't hold a read snapshot across the writes
+            if not owner_ids:
+                return users
+            await run_write(db, lambda session, ids=owner_ids: reconcile_stats(session, list(ids)))
+            users += len(owner_ids)
+            last_id = owner_ids[-1]
+
+async def reconcile_all(batch_size: int = STATS_RECONCILE_BATCH):
+    started = time.perf_counter()
+    users = 0
+    for shard in shards:  # each shard's users table lists the users it holds
+        users += await reconcile_shard(shard.sessions, batch_size)
+    duration = time.perf_counter() - started
+    reconcile_runs.inc()
+    reconcile_time.observe(value=duration)
+    logger.info("Reconciled todo stats for %d users in %.2fs", users, duration)
+
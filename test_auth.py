@@ -1,10 +1,11 @@
 import pytest
-from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from database import Base, get_db
-from main import app
-import random
+from auth import user_cache
+from testing import (
+    SQLALCHEMY_DATABASE_URL, TestingAsyncSessionLocal, TestingSessionLocal, async_engine, client, engine,
+    register_and_login,
+)
+import json
 import os
 import tempfile
 
@@ -13,49 +14,10 @@ os.environ["DISABLE_AUTH"] = "1"
 # another way to disable the warnings
 # pytest -p no:warnings
 
+# The database, the get_db overrides and the client live in testing.py; the per-test
+# rollback and the unique_user / make_client fixtures in conftest.py. Write-path tests
+# are marked committed so they run through the SQLite writer thread, as in production.
 
-# Create a temporary test database file
-db_file = tempfile.NamedTemporaryFile(delete=False, suffix=".db")
-SQLALCHEMY_DATABASE_URL = f"sqlite:///{db_file.name}"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Override the get_db dependency to use the test database
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        yield db
-    finally:
-        db.close()
-
-# Apply the override to use the test database
-app.dependency_overrides[get_db] = override_get_db
-
-# Create a TestClient for testing FastAPI
-client = TestClient(app)
-
-@pytest.fixture(autouse=True)
-def reset_tables():
-    print(f"Resetting database tables for: {SQLALCHEMY_DATABASE_URL}")
-
-    # Drop all tables and recreate them. we need it because we are using the same database for all tests
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
-
-    # Debugging: Ensure tables are empty after reset
-    db = TestingSessionLocal()
-    user_count = db.query(Base.metadata.tables['users']).count()
-    todo_count = db.query(Base.metadata.tables['todos']).count()
-    print(f"Users in database after reset: {user_count}")
-    print(f"Todos in database after reset: {todo_count}")
-    db.close()
-
-# Fixture to provide unique username and password
-@pytest.fixture
-def unique_user():
-    unique_username = "testuser" + str(random.randint(1000, 9999))
-    unique_password = "testpassword" + str(random.randint(1000, 9999))
-    return {"username": unique_username, "password": unique_password}
 
 def test_register_user(unique_user):
     # Use the unique username and password from the fixture
@@ -108,6 +70,7 @@ def test_login(unique_user):
 
 
 
+@pytest.mark.committed
 def test_create_todo_after_login(unique_user):
     # Register the user
     response = client.post("/register", json={"username": unique_user['username'], "password": unique_user['password']})
@@ -216,6 +179,7 @@ def test_get_todo_by_id(unique_user):
     assert data["name"] == "Test Todo"
     assert data["description"] == "This is a test todo"
 
+@pytest.mark.committed
 def test_update_todo_by_id(unique_user):
     # Register and log in the user
     response = client.post("/register", json={"username": unique_user['username'], "password": unique_user['password']})
@@ -261,6 +225,7 @@ def test_update_todo_by_id(unique_user):
     assert data["name"] == "Updated Test Todo"
     assert data["status"] is True
 
+@pytest.mark.committed
 def test_delete_todo_by_id(unique_user):
     # Register and log in the user
     response = client.post("/register", json={"username": unique_user['username'], "password": unique_user['password']})
@@ -306,5 +271,865 @@ def test_delete_todo_by_id(unique_user):
     assert response.json()["detail"] == "Todo not found"
 
 
+def test_get_all_todos_paginated_and_filtered(unique_user):
+    headers = register_and_login(unique_user)
+    for i in range(5):
+        todo_data = {
+            "name": f"Task {i}" if i % 2 else f"Chore {i}",
+            "description": f"This is test todo {i}",
+            "due_date": f"2024-12-0{i + 1}T12:00:00",
+            "status": i == 4,
+        }
+        assert client.post("/todos/", json=todo_data, headers=headers).status_code == 200
+
+    # Walk the listing two rows at a time using the keyset cursor
+    seen = []
+    url = "/todos/?limit=2&sort=due_date&order=desc"
+    while url:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        seen.extend(todo["due_date"] for todo in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        url = f"/todos/?limit=2&sort=due_date&order=desc&cursor={cursor}" if cursor else None
+    assert seen == sorted(seen, reverse=True)
+    assert len(seen) == 5
+
+    response = client.get("/todos/?name_prefix=Task&status=false", headers=headers)
+    assert [todo["name"] for todo in response.json()] == ["Task 1", "Task 3"]
+
+    response = client.get("/todos/?due_after=2024-12-02T00:00:00&due_before=2024-12-04T00:00:00", headers=headers)
+    assert len(response.json()) == 2
+
+    response = client.get("/todos/?cursor=not-a-cursor", headers=headers)
+    assert response.status_code == 400
+
+def test_get_all_todos_ndjson_stream(unique_user):
+    headers = register_and_login(unique_user)
+    for i in range(3):
+        todo_data = {"name": f"Todo {i}", "description": "d", "due_date": "2024-12-31T23:59:59"}
+        assert client.post("/todos/", json=todo_data, headers=headers).status_code == 200
+
+    response = client.get("/todos/?stream=true", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["name"] for row in rows] == ["Todo 0", "Todo 1", "Todo 2"]
+
+
+@pytest.mark.committed
+def test_bulk_todos_single_transaction(unique_user):
+    headers = register_and_login(unique_user)
+    created = client.post("/todos/bulk", json={"create": [
+        {"name": f"Bulk {i}", "description": "d", "due_date": "2024-12-31T23:59:59"} for i in range(4)
+    ]}, headers=headers)
+    assert created.status_code == 200
+    ids = [item["id"] for item in created.json()["created"]]
+    assert len(ids) == 4 and all(item["ok"] for item in created.json()["created"])
+
+    response = client.post("/todos/bulk", json={
+        "update": [{"id": ids[0], "name": "Renamed"}, {"id": 999999, "name": "Missing"}],
+        "toggle": [ids[0], ids[1]],
+        "delete": [ids[2], 999999],
+    }, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["updated"][0]["todo"]["name"] == "Renamed"
+    assert data["updated"][0]["todo"]["description"] == "d"
+    assert data["updated"][1] == {"id": 999999, "ok": False, "detail": "Todo not found", "todo": None}
+    assert [item["todo"]["status"] for item in data["toggled"]] == [True, True]
+    assert [item["ok"] for item in data["deleted"]] == [True, False]
+
+    remaining = client.get("/todos/", headers=headers).json()
+    assert sorted(todo["id"] for todo in remaining) == [ids[0], ids[1], ids[3]]
+
+    # Fields may be omitted but not set to null; the whole batch is rejected
+    response = client.post("/todos/bulk", json={
+        "update": [{"id": ids[0], "name": None}, {"id": ids[1], "due_date": None}],
+    }, headers=headers)
+    assert response.status_code == 422
+    assert {error["loc"][-1] for error in response.json()["detail"]} == {"name", "due_date"}
+    assert client.get(f"/todos/{ids[0]}", headers=headers).json()["name"] == "Renamed"
+
+def test_current_user_is_cached_per_token(unique_user):
+    headers = register_and_login(unique_user)
+    assert client.get("/todos/", headers=headers).status_code == 200
+    hits = user_cache.hits
+    assert client.get("/todos/", headers=headers).status_code == 200
+    assert user_cache.hits == hits + 1
+
+    # Invalidation hook drops every cached token of the user
+    from auth import invalidate_user
+    invalidate_user(unique_user['username'])
+    assert len(user_cache) == 0
+
+def test_password_rehashed_when_cost_changes(monkeypatch):
+    import asyncio
+    import passwords
+
+    monkeypatch.setattr(passwords, "BCRYPT_ROUNDS", 4)
+    hashed = asyncio.run(passwords.hash_password_async("secret"))
+    assert hashed.startswith("$2b$04$")
+
+    valid, new_hash = asyncio.run(passwords.verify_and_update_password("secret", hashed))
+    assert valid and new_hash is None
+
+    monkeypatch.setattr(passwords, "BCRYPT_ROUNDS", 5)
+    valid, new_hash = asyncio.run(passwords.verify_and_update_password("secret", hashed))
+    assert valid and new_hash.startswith("$2b$05$")
+
+    valid, _ = asyncio.run(passwords.verify_and_update_password("wrong", hashed))
+    assert not valid
+
+def test_password_pool_sheds_load_when_full(monkeypatch):
+    import asyncio
+    import passwords
+    from fastapi import HTTPException
+
+    monkeypatch.setattr(passwords.hasher_pool, "in_flight", passwords.hasher_pool.queue_limit)
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(passwords.hash_password_async("secret"))
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers["Retry-After"]
+
+@pytest.mark.committed
+def test_toggle_status(auth_client):
+    from writer import get_writer
+
+    jobs = get_writer(SQLALCHEMY_DATABASE_URL).jobs
+    todo_data = {"name": "Toggle me", "description": "d", "due_date": "2024-12-31T23:59:59"}
+    todo_id = auth_client.post("/todos/", json=todo_data).json()["id"]
+
+    response = auth_client.put(f"/todos/{todo_id}/toggle_status")
+    assert response.status_code == 200
+    assert response.json()["status"] is True
+    assert auth_client.get(f"/todos/{todo_id}").json()["status"] is True
+    # Committed tests write through the writer thread, like production
+    assert get_writer(SQLALCHEMY_DATABASE_URL).jobs == jobs + 2
+
+@pytest.mark.committed
+def test_sqlite_writer_group_commits_and_isolates_failures():
+    import asyncio
+    import threading
+    from database import Todo
+    from writer import SQLiteWriter
+
+    writer = SQLiteWriter(SQLALCHEMY_DATABASE_URL)
+
+    def add_todo(i):
+        def write(session):
+            if i == 3:
+                raise ValueError("boom")
+            todo = Todo(name=f"Writer {i}", description="d", owner_id=1)
+            session.add(todo)
+            session.flush()
+            return todo.id
+        return write
+
+    async def submit_all():
+        return await asyncio.gather(*(writer.submit(add_todo(i)) for i in range(20)), return_exceptions=True)
+
+    # A submitter whose event loop is gone by the time its job commits
+    release = threading.Event()
+    def slow(session):
+        release.wait(5)
+        return add_todo(20)(session)
+
+    async def abandon():
+        asyncio.get_running_loop().create_task(writer.submit(slow))
+        await asyncio.sleep(0)
+
+    try:
+        results = asyncio.run(submit_all())
+        asyncio.run(abandon())
+        release.set()
+        # ...doesn't take the writer thread down
+        assert isinstance(asyncio.run(asyncio.wait_for(writer.submit(add_todo(21)), 5)), int)
+    finally:
+        writer.stop()
+    assert isinstance(results[3], ValueError)
+    assert all(isinstance(result, int) for i, result in enumerate(results) if i != 3)
+    assert writer.jobs == 22 and writer.commits < 22
+
+    db = TestingSessionLocal()
+    assert db.query(Todo).filter(Todo.name.startswith("Writer")).count() == 21
+    db.close()
+
+def test_metrics_endpoint_and_server_timing(unique_user, monkeypatch):
+    import metrics
+
+    headers = register_and_login(unique_user)
+    todo_data = {"name": "Metered", "description": "d", "due_date": "2024-12-31T23:59:59"}
+    todo_id = client.post("/todos/", json=todo_data, headers=headers).json()["id"]
+
+    monkeypatch.setattr(metrics, "SERVER_TIMING", True)
+    response = client.get(f"/todos/{todo_id}", headers=headers)
+    assert response.status_code == 200
+    assert 'db;dur=' in response.headers["server-timing"]
+
+    body = client.get("/metrics").text
+    assert 'todo_http_requests_total{method="GET",route="/todos/{todo_id}",status="200"}' in body
+    assert 'todo_http_request_duration_seconds_count{method="POST",route="/token"}' in body
+    assert 'todo_bcrypt_duration_seconds_count{operation="verify"}' in body
+    assert "todo_db_queries_total" in body
+    assert "todo_jwt_decode_duration_seconds_count" in body
+
+@pytest.mark.committed
+def test_conditional_get_and_if_match(unique_user):
+    headers = register_and_login(unique_user)
+    todo_data = {"name": "Cached", "description": "d", "due_date": "2024-12-31T23:59:59"}
+    created = client.post("/todos/", json=todo_data, headers=headers)
+    todo_id = created.json()["id"]
+    item_etag = created.headers["ETag"]
+
+    listing = client.get("/todos/", headers=headers)
+    list_etag = listing.headers["ETag"]
+    assert listing.headers["Last-Modified"]
+    response = client.get("/todos/", headers={**headers, "If-None-Match": list_etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == list_etag
+
+    response = client.get(f"/todos/{todo_id}", headers={**headers, "If-None-Match": item_etag})
+    assert response.status_code == 304
+
+    # Stale If-Match is rejected; the current one is accepted and yields a new ETag
+    response = client.put(f"/todos/{todo_id}/toggle_status", headers={**headers, "If-Match": '"t0.0"'})
+    assert response.status_code == 412
+    response = client.put(f"/todos/{todo_id}/toggle_status", headers={**headers, "If-Match": item_etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != item_etag
+
+    # Any mutation changes the listing's ETag
+    response = client.get("/todos/", headers={**headers, "If-None-Match": list_etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != list_etag
+
+    response = client.delete(f"/todos/{todo_id}", headers={**headers, "If-Match": item_etag})
+    assert response.status_code == 412
+
+def test_todo_changes_feed(unique_user):
+    headers = register_and_login(unique_user)
+    todo_data = {"name": "Synced", "description": "d", "due_date": "2024-12-31T23:59:59"}
+    first = client.post("/todos/", json=todo_data, headers=headers).json()["id"]
+    second = client.post("/todos/", json=todo_data, headers=headers).json()["id"]
+
+    feed = client.get("/todos/changes", headers=headers).json()
+    assert [change["id"] for change in feed["changes"]] == [first, second]
+    assert feed["has_more"] is False
+    cursor = feed["cursor"]
+
+    # Nothing new since the cursor
+    assert client.get(f"/todos/changes?since={cursor}", headers=headers).json()["changes"] == []
+
+    client.put(f"/todos/{first}/toggle_status", headers=headers)
+    client.delete(f"/todos/{second}", headers=headers)
+    feed = client.get(f"/todos/changes?since={cursor}&limit=1", headers=headers).json()
+    assert feed["has_more"] is True
+    assert feed["changes"][0]["id"] == first and feed["changes"][0]["todo"]["status"] is True
+    feed = client.get(f"/todos/changes?since={feed['cursor']}", headers=headers).json()
+    assert feed["changes"] == [{"id": second, "revision": feed["changes"][0]["revision"], "deleted": True, "todo": None}]
+
+def test_event_hub_fans_out_per_user_and_drops_slow_subscribers():
+    import asyncio
+    from events import DROPPED, EventHub
+
+    async def scenario():
+        hub = EventHub()
+        mine, other = hub.subscribe(1), hub.subscribe(2)
+        slow = hub.subscribe(1)
+        slow.queue = asyncio.Queue(maxsize=1)
+        await hub.publish(1, {"type": "created", "id": 7})
+        await hub.publish(1, {"type": "deleted", "id": 7})
+        received = [await mine.get(1), await mine.get(1)]
+        assert [event["type"] for _, event in received] == ["created", "deleted"]
+        assert await other.get(0.01) is None  # heartbeat timeout, nothing for user 2
+        assert await slow.get(1) is DROPPED
+        for subscriber in (mine, other, slow):
+            hub.unsubscribe(subscriber)
+        assert hub._subscribers == {}
+
+    asyncio.run(scenario())
+
+def test_todo_events_websocket(unique_user):
+    headers = register_and_login(unique_user)
+    token = headers["Authorization"].split()[1]
+    with client.websocket_connect(f"/todos/stream?access_token={token}") as websocket:
+        todo_data = {"name": "Pushed", "description": "d", "due_date": "2024-12-31T23:59:59"}
+        todo_id = client.post("/todos/", json=todo_data, headers=headers).json()["id"]
+        event = websocket.receive_json()
+        assert event["type"] == "created" and event["todo"]["id"] == todo_id
+
+        client.put(f"/todos/{todo_id}/toggle_status", headers=headers)
+        event = websocket.receive_json()
+        assert event["type"] == "toggled" and event["todo"]["status"] is True
+
+    assert client.get("/todos/stream").status_code == 401
+
+def test_search_todos(unique_user):
+    headers = register_and_login(unique_user)
+    todos = [
+        ("Buy milk", "semi-skimmed, from the corner shop"),
+        ("Call plumber", "kitchen sink leaks <again>"),
+        ("Shopping list", "milk, eggs, bread"),
+    ]
+    ids = [
+        client.post("/todos/", json={"name": name, "description": description, "due_date": "2024-12-31T23:59:59"},
+                    headers=headers).json()["id"]
+        for name, description in todos
+    ]
+
+    response = client.get("/todos/search?q=milk", headers=headers)
+    assert response.status_code == 200
+    hits = response.json()
+    assert [hit["id"] for hit in hits] == [ids[0], ids[2]]  # name match ranks above description match
+    assert hits[0]["name_highlight"] == "Buy <mark>milk</mark>"
+
+    # Prefix matching, escaped highlights, and text updates are reindexed by the triggers
+    hit, = client.get("/todos/search?q=lea", headers=headers).json()
+    assert hit["description_highlight"] == "kitchen sink <mark>leaks</mark> &lt;again&gt;"
+    client.put(f"/todos/{ids[1]}", json={"name": "Call plumber", "description": "fixed", "due_date": "2024-12-31T23:59:59",
+                                        "status": True}, headers=headers)
+    assert client.get("/todos/search?q=leaks", headers=headers).json() == []
+
+    page = client.get("/todos/search?q=milk&limit=1", headers=headers)
+    assert [hit["id"] for hit in page.json()] == [ids[0]]
+    rest = client.get(f"/todos/search?q=milk&cursor={page.headers['X-Next-Cursor']}", headers=headers).json()
+    assert [hit["id"] for hit in rest] == [ids[2]]
+
+    # Scoped to the caller
+    other = register_and_login({"username": unique_user["username"] + "x", "password": "pw"})
+    assert client.get("/todos/search?q=milk", headers=other).json() == []
+
+def test_refresh_logout_and_revocation(unique_user):
+    from auth import revoke_user_tokens
+
+    client.post("/register", json=unique_user)
+    tokens = client.post("/token", data=unique_user).json()
+    assert tokens["refresh_token"] and tokens["expires_in"] > 0
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+    assert client.get("/todos/", headers=headers).status_code == 200
+
+    # Refresh tokens can't be used as access tokens, and are single use
+    assert client.get("/todos/", headers={"Authorization": f"Bearer {tokens['refresh_token']}"}).status_code == 401
+    refreshed = client.post("/token/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert refreshed.status_code == 200
+    assert client.post("/token/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+
+    # Logout revokes the access token (even though its user is cached) and the refresh token
+    new_tokens = refreshed.json()
+    new_headers = {"Authorization": f"Bearer {new_tokens['access_token']}"}
+    assert client.get("/todos/", headers=new_headers).status_code == 200
+    assert client.post("/logout", json={"refresh_token": new_tokens["refresh_token"]}, headers=new_headers).status_code == 204
+    assert client.get("/todos/", headers=new_headers).status_code == 401
+    assert client.post("/token/refresh", json={"refresh_token": new_tokens["refresh_token"]}).status_code == 401
+
+    # Forced revocation of everything issued to the user so far
+    revoke_user_tokens(unique_user["username"])
+    assert client.get("/todos/", headers=headers).status_code == 401
+
+@pytest.mark.committed
+def test_concurrent_refreshes_with_one_token(unique_user):
+    import asyncio
+    import httpx
+    from main import app
+
+    register_and_login(unique_user)
+    refresh_token = client.post("/token", data=unique_user).json()["refresh_token"]
+
+    async def refresh_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as concurrent:
+            return await asyncio.gather(*(
+                concurrent.post("/token/refresh", json={"refresh_token": refresh_token}) for _ in range(5)
+            ))
+
+    statuses = sorted(response.status_code for response in asyncio.run(refresh_concurrently()))
+    assert statuses == [200, 401, 401, 401, 401]
+
+def test_signing_key_rotation(monkeypatch):
+    import tokens
+    from jose import JWTError
+
+    ring = tokens.KeyRing.from_env("k1:first-secret")
+    monkeypatch.setattr(tokens, "key_ring", ring)
+    old = tokens.create_token("alice", "access", 60)
+    ring.rotate("k2", "second-secret")
+    new = tokens.create_token("alice", "access", 60)
+    assert tokens.decode_token(old)["sub"] == tokens.decode_token(new)["sub"] == "alice"
+    assert tokens.jwt.get_unverified_header(new)["kid"] == "k2"
+
+    ring.retire("k1")
+    with pytest.raises(JWTError):
+        tokens.decode_token(old)
+    assert tokens.decode_token(new)["sub"] == "alice"
+
+def test_bloom_filter_has_no_false_negatives():
+    from cache import BloomFilter
+
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f"jti-{i}")
+    assert all(f"jti-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+def test_serve_worker_defaults(monkeypatch):
+    import serve
+
+    monkeypatch.delenv("PASSWORD_WORKERS", raising=False)
+    monkeypatch.delenv("EVENTS_BACKEND", raising=False)
+    serve.worker_defaults(workers=64)
+    assert os.environ["PASSWORD_WORKERS"] == "1"
+    assert os.environ["EVENTS_BACKEND"] == "sqlite"
+    assert serve.pick("no_such_module_xyz", "fast", "slow") == "slow"
+    args = serve.parse_args(["--workers", "3", "--reload"])
+    assert args.workers == 3 and args.reload
+
+def test_migrations_upgrade_legacy_database():
+    from sqlalchemy import inspect, text
+    import migrations
+
+    legacy_file = tempfile.NamedTemporaryFile(delete=False, suffix=".db")
+    legacy = create_engine(f"sqlite:///{legacy_file.name}")
+    with legacy.begin() as conn:
+        conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR, password_hash VARCHAR)"))
+        conn.execute(text("CREATE TABLE todos (id INTEGER PRIMARY KEY, name VARCHAR, description TEXT, "
+                          "due_date DATETIME, status BOOLEAN, owner_id INTEGER REFERENCES users (id))"))
+        for ddl in ("CREATE UNIQUE INDEX ix_users_username ON users (username)", "CREATE INDEX ix_users_id ON users (id)",
+                    "CREATE INDEX ix_todos_id ON todos (id)", "CREATE INDEX ix_todos_name ON todos (name)"):
+            conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO users (username, password_hash) VALUES ('old', 'x')"))
+        for i in range(7):
+            conn.execute(text("INSERT INTO todos (name, description, status, owner_id) VALUES (:name, 'd', 0, 1)"),
+                         {"name": f"legacy milk {i}"})
+
+    applied = migrations.upgrade(legacy)
+    assert [m.version for m in applied] == [m.version for m in migrations.MIGRATIONS]
+    assert migrations.upgrade(legacy) == []
+    assert migrations.index_report(legacy)["missing"] == []
+    with legacy.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM todos WHERE updated_at < '1970-01-02'")).scalar() == 0
+        assert conn.execute(text("SELECT COUNT(*) FROM todos_fts WHERE todos_fts MATCH 'milk'")).scalar() == 7
+        assert conn.execute(text("SELECT id, username, shard FROM user_directory")).all() == [(1, "old", 0)]
+    assert "revision" in {col["name"] for col in inspect(legacy).get_columns("todos")}
+    assert "todo_id" not in {col["name"] for col in inspect(legacy).get_columns("scheduler_state")}
+    with legacy.begin() as conn:
+        # Rebuilt with AUTOINCREMENT: the last id isn't handed out again once deleted
+        conn.execute(text("DELETE FROM todos WHERE id = 7"))
+        conn.execute(text("INSERT INTO todos (name, description, status, owner_id) VALUES ('new', 'd', 0, 1)"))
+        assert conn.execute(text("SELECT max(id) FROM todos")).scalar() == 8
+        assert conn.execute(text("SELECT COUNT(*) FROM todos_fts WHERE todos_fts MATCH 'milk'")).scalar() == 6
+        assert conn.execute(text("SELECT total FROM todo_stats WHERE owner_id = 1")).scalar() == 7
+
+    # Batched backfill touches every row in batch-sized transactions
+    assert migrations.backfill(legacy, "todos", "version = 2", "version = 1", batch_size=3, pause=0) == 7
+    legacy.dispose()
+    os.unlink(legacy_file.name)
+
+def test_migrations_build_a_fresh_database_step_by_step(tmp_path):
+    from sqlalchemy import text
+    import migrations
+
+    fresh = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    # Each step only relies on what the earlier ones created
+    migrations.upgrade(fresh, target=1)
+    with fresh.begin() as conn:
+        conn.execute(text("INSERT INTO users (username, password_hash) VALUES ('u', 'x')"))
+        conn.execute(text("INSERT INTO todos (name, description, status, owner_id) VALUES ('early milk', 'd', 0, 1)"))
+    migrations.upgrade(fresh)
+    assert migrations.index_report(fresh) == {"missing": [], "unexpected": []}
+    with fresh.begin() as conn:
+        conn.execute(text("INSERT INTO todos (name, description, status, owner_id) VALUES ('late milk', 'd', 0, 1)"))
+        assert conn.execute(text("SELECT COUNT(*) FROM todos_fts WHERE todos_fts MATCH 'milk'")).scalar() == 2
+        assert conn.execute(text("SELECT total FROM todo_stats WHERE owner_id = 1")).scalar() == 2
+    fresh.dispose()
+
+def test_migrations_cli_covers_every_shard(tmp_path, capsys):
+    import asyncio
+    import database
+    import migrations
+    from sqlalchemy import inspect
+
+    saved = list(database.shards)
+    database.shards[:] = [database._open_shard(i, f"sqlite:///{tmp_path / f'shard{i}.db'}") for i in range(2)]
+    try:
+        assert migrations.main(["upgrade"]) == 0
+        assert migrations.main(["indexes"]) == 0
+        migrations.main(["status"])
+        output = capsys.readouterr().out
+        assert output.count("shard 0  ") == 3 and output.count("shard 1  ") == 3
+        assert "pending" not in output
+        # The directory lives on shard 0 only
+        assert [inspect(shard.engine).has_table("user_directory") for shard in database.shards] == [True, False]
+    finally:
+        for shard in database.shards:
+            shard.engine.dispose()
+            asyncio.run(shard.async_engine.dispose())
+        database.shards[:] = saved
+
+def test_login_and_write_rate_limits(unique_user, monkeypatch):
+    import ratelimit
+
+    monkeypatch.setitem(ratelimit.BUDGETS, "login_user", ratelimit.Budget(per_minute=1, burst=2))
+    monkeypatch.setitem(ratelimit.BUDGETS, "writes", ratelimit.Budget(per_minute=1, burst=1))
+    headers = register_and_login(unique_user)  # spends one login_user token
+
+    bad = {"username": unique_user["username"], "password": "wrong"}
+    assert client.post("/token", data=bad).status_code == 401
+    response = client.post("/token", data=bad)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+    todo_data = {"name": "Limited", "description": "d", "due_date": "2024-12-31T23:59:59"}
+    assert client.post("/todos/", json=todo_data, headers=headers).status_code == 200
+    assert client.post("/todos/", json=todo_data, headers=headers).status_code == 429
+    assert client.get("/todos/", headers=headers).status_code == 200  # reads aren't limited
+
+def test_admission_control_sheds_load(monkeypatch):
+    import ratelimit
+
+    monkeypatch.setattr(ratelimit.request_slots, "in_flight", ratelimit.request_slots.limit)
+    response = client.get("/todos/")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/metrics").status_code == 200  # exempt
+
+def test_sqlite_rate_limit_backend_is_shared(tmp_path):
+    import asyncio
+    from ratelimit import Budget, SQLiteBackend
+
+    path = str(tmp_path / "limits.db")
+    first, second = SQLiteBackend(path), SQLiteBackend(path)
+    budget = Budget(per_minute=60, burst=2)
+
+    async def hits():
+        return [await backend.acquire("k", budget) for backend in (first, second, first)]
+
+    waits = asyncio.run(hits())
+    assert waits[:2] == [0.0, 0.0] and 0 < waits[2] <= 1
+
+@pytest.mark.committed
+def test_export_and_import_roundtrip(unique_user, monkeypatch):
+    import todo
+
+    monkeypatch.setattr(todo, "IMPORT_CHUNK_SIZE", 2)
+    headers = register_and_login(unique_user)
+    csv_body = (
+        "name,description,due_date,status\n"
+        "Imported 1,\"multi\nline, quoted\",2024-12-31T23:59:59,true\n"
+        "Broken,d,not-a-date,\n"
+        "Imported 2,d,2025-01-01T00:00:00,\n"
+        "Imported 3,d,2025-01-02T00:00:00,0\n"
+    )
+    response = client.post("/todos/import", files={"file": ("todos.csv", csv_body, "text/csv")}, headers=headers)
+    assert response.status_code == 200
+    report = response.json()
+    assert report["imported"] == 3 and report["failed"] == 1 and report["chunks"] == 2
+    assert report["errors"][0]["line"] == 4 and "due_date" in report["errors"][0]["error"]
+
+    exported = client.get("/todos/export?format=csv", headers=headers)
+    assert exported.headers["content-type"].startswith("text/csv")
+    lines = exported.text.splitlines()
+    assert lines[0] == "id,name,description,due_date,status"
+    assert "multi" in exported.text and len(exported.text.strip().split("Imported")) == 4
+
+    ndjson = client.get("/todos/export", headers=headers).text.splitlines()
+    assert [json.loads(line)["name"] for line in ndjson] == ["Imported 1", "Imported 2", "Imported 3"]
+    assert json.loads(ndjson[0])["description"] == "multi\nline, quoted"
+
+    # NDJSON import from the export, plus a bad line
+    body = "\n".join(ndjson) + "\n{not json\n"
+    report = client.post("/todos/import?format=ndjson", files={"file": ("x", body)}, headers=headers).json()
+    assert report["imported"] == 3 and report["failed"] == 1
+    assert len(client.get("/todos/?limit=100", headers=headers).json()) == 6
+
+    # A file that can't be decoded counts as a failure, not an empty success
+    report = client.post("/todos/import", files={"file": ("x.csv", b"name\n\xff\xfe\n")}, headers=headers).json()
+    assert report["imported"] == 0 and report["failed"] == 1 and report["errors"][0]["line"] == 0
+
+@pytest.mark.committed
+def test_todo_stats_counters(unique_user):
+    from datetime import datetime, timedelta, timezone
+    from sqlalchemy import text
+    from stats import reconcile_stats
+
+    headers = register_and_login(unique_user)
+    today = datetime.now(timezone.utc).replace(hour=12, minute=0, second=0, microsecond=0)
+    def due(days):
+        return (today + timedelta(days=days)).isoformat()
+
+    ids = [client.post("/todos/", json={"name": f"T{days}", "description": "d", "due_date": due(days)}, headers=headers).json()["id"]
+           for days in (-3, 0, 2, 10)]
+    client.post("/todos/bulk", json={"create": [{"name": "B", "description": "d", "due_date": due(0)}]}, headers=headers)
+    client.put(f"/todos/{ids[0]}/toggle_status", headers=headers)  # overdue one done
+    updated = {"name": "T", "description": "d", "due_date": due(-1), "status": False}
+    assert client.put(f"/todos/{ids[2]}", json=updated, headers=headers).status_code == 200
+    client.delete(f"/todos/{ids[3]}", headers=headers)
+    csv_body = f"name,description,due_date,status\nI,d,{due(5)},\n"
+    client.post("/todos/import", files={"file": ("t.csv", csv_body, "text/csv")}, headers=headers)
+
+    expected = {"total": 5, "done": 1, "open": 4, "overdue": 1, "due_today": 2, "due_this_week": 3}
+    stats = client.get("/todos/stats", headers=headers).json()
+    assert {key: stats[key] for key in expected} == expected
+    assert stats["as_of"] == today.date().isoformat()
+
+    # Writes behind the triggers' back drift the counters; reconciling repairs them
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE todo_stats SET total = 99"))
+        conn.execute(text("DELETE FROM todo_due_counts"))
+    with TestingSessionLocal() as session, session.begin():
+        reconcile_stats(session, session.execute(text("SELECT id FROM users")).scalars().all())
+    stats = client.get("/todos/stats", headers=headers).json()
+    assert {key: stats[key] for key in expected} == expected
+
+
+@pytest.mark.committed
+def test_due_date_scheduler(unique_user, monkeypatch, tmp_path):
+    import asyncio
+    from datetime import datetime, timedelta
+    import scheduler
+
+    monkeypatch.setattr(scheduler, "AsyncSessionLocal", TestingAsyncSessionLocal)
+    headers = register_and_login(unique_user)
+    now = datetime.utcnow()
+    def add(minutes, name):
+        data = {"name": name, "description": "d", "due_date": (now + timedelta(minutes=minutes)).isoformat()}
+        return client.post("/todos/", json=data, headers=headers).json()["id"]
+
+    class Recorder(scheduler.Notifier):
+        def __init__(self):
+            self.sent = []
+        async def notify(self, kind, todos):
+            self.sent += [(kind, todo["name"]) for todo in todos]
+
+    notifier = Recorder()
+    job = scheduler.DueDateJob("reminder", timedelta(minutes=60))
+    def run(at):
+        return asyncio.run(scheduler.run_due_date_job(job, notifier, now=at, batch_size=2))
+
+    add(-5, "past")  # before the first run's starting point
+    for minutes, name in ((10, "soon 1"), (20, "soon 2"), (30, "soon 3"), (120, "later")):
+        add(minutes, name)
+    client.put(f"/todos/{add(15, 'done')}/toggle_status", headers=headers)
+
+    assert run(now) == 3
+    assert notifier.sent == [("reminder", "soon 1"), ("reminder", "soon 2"), ("reminder", "soon 3")]
+    assert run(now) == 0  # notified todos are remembered between runs
+    add(40, "added later")
+    assert run(now + timedelta(minutes=5)) == 1
+    # Due before todos already reminded of: still picked up
+    add(12, "added sooner")
+    assert run(now + timedelta(minutes=6)) == 1 and notifier.sent[-1] == ("reminder", "added sooner")
+    # Moved to another due date: reminded again
+    moved = add(25, "moved")
+    assert run(now + timedelta(minutes=7)) == 1
+    client.put(f"/todos/{moved}", json={"name": "moved", "description": "d", "status": False,
+                                        "due_date": (now + timedelta(minutes=50)).isoformat()}, headers=headers)
+    assert run(now + timedelta(minutes=8)) == 1 and notifier.sent[-1] == ("reminder", "moved")
+    assert run(now + timedelta(minutes=90)) == 1 and notifier.sent[-1] == ("reminder", "later")
+    # The window trails now by at most the catch-up period; older markers are pruned
+    assert run(now + timedelta(hours=scheduler.SCHEDULER_CATCH_UP_HOURS + 3)) == 0
+    from database import SchedulerNotification
+    with TestingSessionLocal() as db:
+        assert db.query(SchedulerNotification).count() == 0
+
+    # One scheduler per host runs the jobs
+    lock = str(tmp_path / "scheduler.lock")
+    first, second = scheduler.Scheduler(lock_path=lock), scheduler.Scheduler(lock_path=lock)
+    assert first.is_leader() and not second.is_leader()
+    asyncio.run(first.stop())
+    assert second.is_leader()
+    asyncio.run(second.stop())
+
+
+def test_static_assets_and_gzip(unique_user, monkeypatch):
+    from assets import asset_url, assets
+
+    page = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert page.status_code == 200 and "<html" in page.text.lower()
+    assert page.headers["content-encoding"] == "gzip" and page.headers["cache-control"] == "no-cache"
+    assert client.get("/", headers={"If-None-Match": page.headers["etag"]}).status_code == 304
+    assert "content-encoding" not in client.get("/static/index.html", headers={"Accept-Encoding": "identity"}).headers
+
+    url = asset_url("index.html")
+    assert url != "/static/index.html"
+    fingerprinted = client.get(url)
+    assert fingerprinted.text == page.text and "immutable" in fingerprinted.headers["cache-control"]
+    assert client.get("/static/missing.js").status_code == 404
+    assert client.get("/static/../main.py").status_code == 404
+
+    # No bundled client: a plain 404, like /static
+    monkeypatch.setattr(assets, "lookup", lambda path: (None, False))
+    assert client.get("/").status_code == 404
+
+    headers = register_and_login(unique_user)
+    client.post("/todos/bulk", json={"create": [
+        {"name": f"Todo {i}", "description": "x" * 50, "due_date": "2024-12-31T23:59:59"} for i in range(30)
+    ]}, headers=headers)
+    listing = client.get("/todos/?limit=30", headers={**headers, "Accept-Encoding": "gzip"})
+    assert listing.headers["content-encoding"] == "gzip" and len(listing.json()) == 30
+    assert "content-encoding" not in client.get("/todos/stats", headers={**headers, "Accept-Encoding": "gzip"}).headers
+
+
+@pytest.mark.committed
+def test_users_sharded_and_moved(tmp_path):
+    import asyncio
+    import database
+    import migrations
+    import shards
+    from sqlalchemy import inspect as sa_inspect, text
+
+    # Shard 0 is the test database (it holds the directory), shard 1 a fresh file
+    saved = list(database.shards)
+    extra = database._open_shard(1, f"sqlite:///{tmp_path / 'shard1.db'}")
+    database.shards[:] = [database.Shard(0, SQLALCHEMY_DATABASE_URL, engine, async_engine, TestingAsyncSessionLocal), extra]
+    try:
+        migrations.upgrade(extra.engine)
+        assert "user_directory" not in sa_inspect(extra.engine).get_table_names()
+        placed = {}
+        for i in range(8):
+            user = {"username": f"sharded{i}", "password": "pw"}
+            user_id = client.post("/register", json=user).json()["id"]
+            placed.setdefault(database.placement_shard(user_id), user)
+        assert set(placed) == {0, 1}
+
+        token = client.post("/token", data=placed[1]).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        ids = [client.post("/todos/", json={"name": f"Far {i}", "description": "d", "due_date": "2030-01-01T00:00:00"},
+                           headers=headers).json()["id"] for i in range(3)]
+        client.delete(f"/todos/{ids[2]}", headers=headers)
+        cursor = client.get("/todos/changes", headers=headers).json()["cursor"]
+        with extra.engine.connect() as conn:
+            assert conn.execute(text("SELECT COUNT(*) FROM todos")).scalar() == 2
+        with engine.connect() as conn:
+            assert conn.execute(text("SELECT COUNT(*) FROM todos")).scalar() == 0
+        assert client.get("/todos/stats", headers=headers).json()["total"] == 2
+
+        # Move to shard 0: same todos under new ids, old ids reported deleted
+        assert shards.move_user(placed[1]["username"], 0) == 2
+        assert shards.users_per_shard()[1] == 0
+        user_cache.clear()
+        moved = client.get("/todos/", headers=headers).json()
+        assert sorted(todo["name"] for todo in moved) == ["Far 0", "Far 1"]
+        assert not {todo["id"] for todo in moved} & set(ids)
+        changes = client.get(f"/todos/changes?since={cursor}", headers=headers).json()["changes"]
+        assert sorted(change["id"] for change in changes if change["deleted"]) == sorted(ids[:2])
+        assert client.get("/todos/stats", headers=headers).json()["total"] == 2
+        with extra.engine.connect() as conn:
+            assert conn.execute(text("SELECT COUNT(*) FROM todos")).scalar() == 0
+    finally:
+        database.shards[:] = saved
+        extra.engine.dispose()
+        asyncio.run(extra.async_engine.dispose())
+
+
+def test_shard_engines_for_async_driver_urls(tmp_path):
+    import asyncio
+    import database
+    from sqlalchemy import text
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    # An async-driver URL still gets a sync engine with a sync pool, and the other way round
+    shard = database._open_shard(1, f"sqlite+aiosqlite:///{tmp_path / 'shard.db'}")
+    try:
+        assert shard.engine.url.drivername == "sqlite"
+        assert not isinstance(shard.engine.pool, AsyncAdaptedQueuePool)
+        assert shard.async_engine.url.drivername == "sqlite+aiosqlite"
+        with shard.engine.connect() as conn:
+            assert conn.execute(text("SELECT 1")).scalar() == 1
+    finally:
+        shard.engine.dispose()
+        asyncio.run(shard.async_engine.dispose())
+
+
+def test_single_flight_shares_one_call():
+    import asyncio
+    from cache import SingleFlight
+
+    flights = SingleFlight()
+    calls = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def query():
+            calls.append(1)
+            await release.wait()
+            return "rows"
+
+        waiting = [asyncio.create_task(flights.do("key", query)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiting)
+        return results, await flights.do("key", query)  # nothing is cached afterwards
+
+    results, later = asyncio.run(scenario())
+    assert results == ["rows"] * 5 and later == "rows"
+    assert len(calls) == 2 and flights.shared == 4
+
+@pytest.mark.committed
+def test_idempotency_keys_replay_writes(unique_user):
+    user = {"username": unique_user["username"], "password": unique_user["password"]}
+    first = client.post("/register", json=user, headers={"Idempotency-Key": "reg-1"})
+    retry = client.post("/register", json=user, headers={"Idempotency-Key": "reg-1"})
+    assert retry.status_code == 200 and retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert client.post("/register", json=user).status_code == 400
+    # Register keys are scoped by username: another client's identical key is a new request
+    other = client.post("/register", json={"username": user["username"] + "b", "password": "other"},
+                        headers={"Idempotency-Key": "reg-1"})
+    assert other.status_code == 200 and "Idempotent-Replayed" not in other.headers
+    assert other.json()["username"] == user["username"] + "b"
+
+    headers = {"Authorization": f"Bearer {client.post('/token', data=user).json()['access_token']}"}
+    todo_data = {"name": "Once", "description": "d", "due_date": "2024-12-31T23:59:59"}
+    created = [client.post("/todos/", json=todo_data, headers={**headers, "Idempotency-Key": "create-1"}) for _ in range(3)]
+    assert len({response.json()["id"] for response in created}) == 1
+    assert created[2].headers["etag"] == created[0].headers["etag"]
+    assert len(client.get("/todos/", headers=headers).json()) == 1
+    different = client.post("/todos/", json={**todo_data, "name": "Other"}, headers={**headers, "Idempotency-Key": "create-1"})
+    assert different.status_code == 422
+
+    todo_id = created[0].json()["id"]
+    for _ in range(2):
+        deleted = client.delete(f"/todos/{todo_id}", headers={**headers, "Idempotency-Key": "delete-1"})
+        assert deleted.status_code == 200 and deleted.json() == {"detail": "Todo deleted successfully"}
+    assert client.delete(f"/todos/{todo_id}", headers=headers).status_code == 404
+
+
+def test_each_test_runs_in_a_rolled_back_transaction(make_client):
+    from database import Todo
+
+    alice, bob = make_client(), make_client()
+    assert alice.post("/todos/", json={"name": "Uncommitted", "description": "d", "due_date": "2024-12-31T23:59:59"}).status_code == 200
+    assert [todo["name"] for todo in alice.get("/todos/").json()] == ["Uncommitted"]
+    assert bob.get("/todos/").json() == []
+
+    # The app's commits only released SAVEPOINTs: other connections see nothing
+    with TestingSessionLocal() as db:
+        assert db.query(Todo).count() == 0
+
+@pytest.mark.committed
+def test_deleted_todo_ids_are_not_reused(auth_client):
+    todo_data = {"name": "First", "description": "d", "due_date": "2024-12-31T23:59:59"}
+    auth_client.post("/todos/", json=todo_data)
+    deleted = auth_client.post("/todos/", json={**todo_data, "name": "Deleted"})
+    deleted_id, deleted_etag = deleted.json()["id"], deleted.headers["ETag"]
+    assert auth_client.delete(f"/todos/{deleted_id}").status_code == 200
+
+    created = auth_client.post("/todos/", json={**todo_data, "name": "New"})
+    new_id = created.json()["id"]
+    assert new_id > deleted_id
+    assert created.headers["ETag"] != deleted_etag
+
+    # The deleted todo's validators match nothing
+    response = auth_client.get(f"/todos/{deleted_id}", headers={"If-None-Match": deleted_etag})
+    assert response.status_code == 404
+    response = auth_client.get(f"/todos/{new_id}", headers={"If-None-Match": deleted_etag})
+    assert response.status_code == 200
+    response = auth_client.put(f"/todos/{new_id}", json={**todo_data, "name": "Overwrite", "status": False},
+                               headers={"If-Match": deleted_etag})
+    assert response.status_code == 412
+    assert auth_client.get(f"/todos/{new_id}").json()["name"] == "New"
+
 
 # run test: pytest test_auth.py or  'pytest -p no:warnings'. You need to be activated the virtual environment
\ No newline at end of file
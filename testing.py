@@ -0,0 +1,80 @@
+# testing.py
+"""Shared test setup: the per-worker database, its engines and the test client.
+
+Imported by conftest.py before any app module, so the environment below is what the
+app reads. Tests import what they need from here; fixtures live in conftest.py.
+"""
+import os
+import tempfile
+
+# Must be set before the app modules read them
+WORKER = os.getenv("PYTEST_XDIST_WORKER", "main")
+TEST_DB_DIR = tempfile.mkdtemp(prefix=f"todo-tests-{WORKER}-")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(TEST_DB_DIR, 'todo.db')}"
+os.environ.setdefault("DATABASE_URL", SQLALCHEMY_DATABASE_URL)
+os.environ.setdefault("BCRYPT_ROUNDS", "4")  # bcrypt's minimum
+os.environ.setdefault("PASSWORD_WORKERS", "0")  # no process pool to spawn
+os.environ.setdefault("SCHEDULER_ENABLED", "0")
+os.environ.setdefault("RATE_LIMIT_PATH", os.path.join(TEST_DB_DIR, "ratelimit.db"))
+os.environ.setdefault("TODO_DB_INITIALIZED", "1")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from auth import get_db as auth_get_db
+from database import Base, Todo, apply_sqlite_pragmas, get_db
+from main import app
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# NullPool: tests also drive the engine from their own asyncio.run() loops
+async_engine = create_async_engine(SQLALCHEMY_DATABASE_URL.replace("sqlite:", "sqlite+aiosqlite:"), poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# WAL and the other production pragmas, so the writer thread and readers don't block each other
+apply_sqlite_pragmas(engine)
+apply_sqlite_pragmas(async_engine)
+
+# pysqlite/aiosqlite issue BEGIN lazily and mishandle SAVEPOINT; let SQLAlchemy do it
+@event.listens_for(async_engine.sync_engine, "connect")
+def _disable_driver_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(async_engine.sync_engine, "begin")
+def _begin(connection):
+    connection.exec_driver_sql("BEGIN")
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+def use_db(dependency):
+    # auth has its own get_db dependency
+    app.dependency_overrides[get_db] = dependency
+    app.dependency_overrides[auth_get_db] = dependency
+
+use_db(override_get_db)
+
+client = TestClient(app)
+
+
+def empty_tables():
+    with engine.begin() as conn:
+        conn.execute(Todo.__table__.delete())  # first, so the stats triggers run before their tables are emptied
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+
+def register_and_login(user, test_client=client):
+    response = test_client.post("/register", json={"username": user['username'], "password": user['password']})
+    assert response.status_code == 200
+    response = test_client.post(
+        "/token",
+        data={"username": user['username'], "password": user['password']},
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
@@ -0,0 +1,170 @@
+# tokens.py
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+from jose import JWTError, jwt
+
+from cache import BloomFilter, TTLCache
+from metrics import observe_jwt_decode
+
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
+
+# Signing keys as "kid:secret,kid:secret". The first one signs new tokens; the rest
+# still verify, so a rotation is: prepend the new key, wait one refresh-token
+# lifetime, then drop the old key. JWT_SECRET_KEY is the single-key shorthand.
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your_secret_key")  # Change this to a strong secret key
+JWT_SIGNING_KEYS = os.getenv("JWT_SIGNING_KEYS", "")
+
+# Tokens whose signature and claims were already verified, kept until they expire
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", "50000"))
+REVOCATION_CAPACITY = int(os.getenv("REVOCATION_CAPACITY", "100000"))
+
+
+class KeyRing:
+    def __init__(self, keys: Dict[str, str]):
+        if not keys:
+            raise ValueError("At least one signing key is required")
+        self._keys = dict(keys)
+        self.active_kid = next(iter(keys))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, spec: str = JWT_SIGNING_KEYS, default_secret: str = JWT_SECRET_KEY):
+        keys = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            kid, sep, secret = item.partition(":")
+            if not sep or not kid or not secret:
+                raise ValueError(f"Invalid JWT_SIGNING_KEYS entry: {kid!r}")
+            keys[kid] = secret
+        return cls(keys or {"default": default_secret})
+
+    def rotate(self, kid: str, secret: str):
+        """Start signing with a new key; previously issued tokens keep verifying."""
+        with self._lock:
+            self._keys[kid] = secret
+            self.active_kid = kid
+
+    def retire(self, kid: str):
+        with self._lock:
+            if kid == self.active_kid:
+                raise ValueError("Cannot retire the active signing key")
+            self._keys.pop(kid, None)
+        verified_tokens.clear()  # cached tokens signed with it must be re-verified (and fail)
+
+    def signing_key(self):
+        with self._lock:
+            return self.active_kid, self._keys[self.active_kid]
+
+    def get(self, kid: Optional[str]) -> Optional[str]:
+        # Tokens issued before kid headers existed were signed with the active key
+        return self._keys.get(kid if kid is not None else self.active_kid)
+
+
+class RevocationList:
+    """Revoked token ids (jti) plus per-user "not before" cut-offs, all in memory.
+
+    A bloom filter sits in front of the exact set: the common case (token not revoked)
+    is answered without touching the lock or the set. Entries are dropped once the
+    token would have expired anyway, and the filter is rebuilt from what remains.
+    """
+
+    def __init__(self, capacity: int = REVOCATION_CAPACITY):
+        self.capacity = capacity
+        self._bloom = BloomFilter(capacity)
+        self._revoked: Dict[str, float] = {}  # jti -> exp
+        self._not_before: Dict[str, float] = {}  # sub -> revoke everything issued before this
+        self._lock = threading.Lock()
+
+    def revoke(self, jti: str, expires_at: float):
+        with self._lock:
+            if len(self._revoked) >= self.capacity:
+                self._prune()
+            self._revoked[jti] = expires_at
+            self._bloom.add(jti)
+
+    def claim(self, jti: str, expires_at: float) -> bool:
+        """Revoke `jti` unless it already is; True only for the one caller that revoked it.
+        Makes single-use tokens safe against concurrent replays."""
+        with self._lock:
+            if jti in self._revoked:
+                return False
+            if len(self._revoked) >= self.capacity:
+                self._prune()
+            self._revoked[jti] = expires_at
+            self._bloom.add(jti)
+            return True
+
+    def revoke_subject(self, sub: str, before: Optional[float] = None):
+        with self._lock:
+            self._not_before[sub] = time.time() if before is None else before
+
+    def is_revoked(self, claims: dict) -> bool:
+        not_before = self._not_before.get(claims.get("sub"))
+        if not_before is not None and claims.get("iat", 0) < not_before:
+            return True
+        jti = claims.get("jti")
+        if jti is None or jti not in self._bloom:
+            return False
+        with self._lock:
+            return jti in self._revoked
+
+    def clear(self):
+        with self._lock:
+            self._revoked.clear()
+            self._not_before.clear()
+            self._bloom = BloomFilter(self.capacity)
+
+    def __len__(self):
+        return len(self._revoked)
+
+    # Caller must hold the lock
+    def _prune(self):
+        now = time.time()
+        self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+        self._bloom = BloomFilter(self.capacity)
+        for jti in self._revoked:
+            self._bloom.add(jti)
+
+
+key_ring = KeyRing.from_env()
+revocations = RevocationList()
+verified_tokens = TTLCache(maxsize=VERIFIED_TOKEN_CACHE_SIZE, ttl=REFRESH_TOKEN_EXPIRE_DAYS * 86400)
+
+
+def create_token(sub: str, token_type: str, expires_in: float, **claims) -> str:
+    kid, secret = key_ring.signing_key()
+    now = time.time()
+    payload = {
+        **claims,
+        "sub": sub,
+        "type": token_type,
+        "jti": uuid.uuid4().hex,
+        "iat": now,
+        "exp": int(now + expires_in),
+    }
+    return jwt.encode(payload, secret, algorithm=ALGORITHM, headers={"kid": kid})
+
+
+def decode_token(token: str, token_type: str = "access") -> dict:
+    """Verified claims of `token`; raises JWTError. Revocation is checked separately."""
+    claims = verified_tokens.get(token)
+    if claims is None:
+        started = time.perf_counter()
+        try:
+            secret = key_ring.get(jwt.get_unverified_header(token).get("kid"))
+            if secret is None:
+                raise JWTError("Unknown signing key")
+            claims = jwt.decode(token, secret, algorithms=[ALGORITHM])
+        finally:
+            observe_jwt_decode(time.perf_counter() - started)
+        # Cached for the token's remaining lifetime only
+        verified_tokens.set(token, claims, ttl=claims["exp"] - time.time())
+    # Tokens from before typed tokens existed are access tokens
+    if claims.get("type", "access") != token_type:
+        raise JWTError("Wrong token type")
+    return claims
@@ -0,0 +1,157 @@
+# writer.py
+import asyncio
+import contextvars
+import logging
+import os
+import queue
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from database import apply_sqlite_pragmas, is_sqlite, sync_url
+
+# SQLite allows one writer at a time. Instead of letting request handlers race for the
+# lock (and hit "database is locked"), every write is funnelled through a dedicated
+# thread per database file which applies queued jobs back-to-back and commits them
+# together. Reads keep using the async pool and see WAL snapshots in parallel.
+SQLITE_WRITER = os.getenv("SQLITE_WRITER", "1") == "1"
+WRITER_MAX_BATCH = int(os.getenv("SQLITE_WRITER_MAX_BATCH", "128"))
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class SQLiteWriter:
+    def __init__(self, url: str, max_batch: int = WRITER_MAX_BATCH):
+        self.url = url
+        self.max_batch = max_batch
+        self.engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        apply_sqlite_pragmas(self.engine)
+        # Let SQLAlchemy, not the sqlite3 module, drive transactions so per-job SAVEPOINTs
+        # work, and take the write lock up front with BEGIN IMMEDIATE.
+        event.listen(self.engine, "connect", _disable_pysqlite_transactions)
+        event.listen(self.engine, "begin", _begin_immediate)
+        self.commits = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"sqlite-writer:{url}", daemon=True)
+        self._thread.start()
+
+    async def submit(self, fn):
+        """Run fn(session) on the writer thread; resolves once its batch has committed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Carry the request's context (e.g. metrics.request_stats) over to the writer thread
+        self._queue.put((fn, loop, future, contextvars.copy_context()))
+        return await future
+
+    def stop(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+        self.engine.dispose()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            batch = [job]
+            stop = False
+            # Group commit: take whatever else queued up while we were busy
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stop = True
+                    break
+                batch.append(job)
+            try:
+                self._apply(batch)
+            except Exception:
+                # Never let one batch take the thread down: later submits would hang forever
+                logger.exception("SQLite writer failed to apply a batch")
+            if stop:
+                return
+
+    def _apply(self, batch):
+        outcomes = []
+        with Session(self.engine, autoflush=False, expire_on_commit=False) as session:
+            try:
+                for fn, _, _, context in batch:
+                    # A savepoint per job so one failing request doesn't poison the batch
+                    savepoint = session.begin_nested()
+                    try:
+                        result = context.run(fn, session)
+                        context.run(session.flush)
+                        savepoint.commit()
+                        outcomes.append((result, None))
+                    except Exception as exc:
+                        savepoint.rollback()
+                        outcomes.append((None, exc))
+                session.commit()
+                self.commits += 1
+                self.jobs += len(batch)
+            except Exception as exc:
+                logger.exception("SQLite writer batch failed")
+                session.rollback()
+                outcomes = [(None, exc)] * len(batch)
+
+        for (_, loop, future, _), (result, exc) in zip(batch, outcomes):
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, exc)
+            except RuntimeError:
+                # The submitter's event loop has closed; nobody is waiting for this result
+                logger.warning("SQLite writer dropped a result for a closed event loop")
+
+
+def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+def _begin_immediate(connection):
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _resolve(future, result, exc):
+    if future.cancelled():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(url: str) -> SQLiteWriter:
+    with _writers_lock:
+        writer = _writers.get(url)
+        if writer is None:
+            writer = _writers[url] = SQLiteWriter(url)
+        return writer
+
+def stop_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.stop()
+
+
+async def run_write(db, fn):
+    """Apply fn(session) as one write transaction against the database behind `db`.
+
+    SQLite files go through their single writer thread; other databases (or
+    SQLITE_WRITER=0) run fn on the request's own session and commit it.
+    """
+    url = db.bind.engine.url  # the session may be bound to an engine or a connection
+    if SQLITE_WRITER and is_sqlite(url) and url.database not in (None, "", ":memory:"):
+        return await get_writer(sync_url(url)).submit(fn)
+    result = await db.run_sync(fn)
+    await db.commit()
+    return result